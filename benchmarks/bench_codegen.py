@@ -0,0 +1,43 @@
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from engine import GeneratedMatcher, KnowledgeBase
+
+def throughput(fn, fact_sets) -> float:
+    start = time.perf_counter()
+    for facts in fact_sets:
+        fn(facts)
+    return len(fact_sets) / (time.perf_counter() - start)
+
+def main():
+    random.seed(0)
+    vocabulary = [f'indicator_{i}' for i in range(2000)]
+    kb = KnowledgeBase(engine='naive')
+    for i in range(20000):
+        kb.add_rule(random.sample(vocabulary, random.randint(2, 4)), f'issue_{i}', 0.8)
+    fact_sets = [set(random.sample(vocabulary, 30)) for _ in range(2000)]
+
+    def interpret(facts):
+        kb.facts = facts
+        return kb.evaluate_rules()
+
+    cache_dir = tempfile.mkdtemp()
+    start = time.perf_counter()
+    matcher = GeneratedMatcher(kb, cache_dir=cache_dir)
+    cold = time.perf_counter() - start
+    start = time.perf_counter()
+    GeneratedMatcher(kb, cache_dir=cache_dir)
+    warm = time.perf_counter() - start
+
+    print(f"{len(kb.rules)} rules, {len(vocabulary)} indicators")
+    print(f"generate+compile: {cold * 1000:.0f} ms, load from cache: {warm * 1000:.0f} ms")
+    print(f"interpreter loop: {throughput(interpret, fact_sets):10.0f} fact sets/s")
+    print(f"generated code:   {throughput(matcher.diagnose, fact_sets):10.0f} fact sets/s")
+
+if __name__ == '__main__':
+    main()
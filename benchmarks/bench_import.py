@@ -0,0 +1,42 @@
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Each snippet runs in a fresh interpreter so every import is a cold start.
+SNIPPETS = {
+    'engine': "import engine",
+    'engine + analyze': (
+        "import engine\n"
+        "kb, kg = engine.KnowledgeBase(), engine.KnowledgeGraph()\n"
+        "engine.setup_manufacturing_knowledge(kb, kg)\n"
+        "kb.add_fact('vibration'); kb.add_fact('unusual_noise')\n"
+        "kb.analyze(kg)"),
+    'main_4 (GUI)': "import main_4",
+}
+GUI_MODULES = ('PyQt6', 'matplotlib', 'networkx')
+
+def cold_start(snippet: str, runs: int) -> tuple:
+    code = ("import sys, time\n"
+            "start = time.perf_counter()\n"
+            f"{snippet}\n"
+            "elapsed = time.perf_counter() - start\n"
+            f"print(elapsed, *[m for m in {GUI_MODULES!r} if m in sys.modules])")
+    env = dict(os.environ, QT_QPA_PLATFORM='offscreen')
+    times = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=env,
+                             capture_output=True, text=True, check=True).stdout.split()
+        times.append(float(out[0]))
+    return statistics.median(times), out[1:]
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 7
+    for name, snippet in SNIPPETS.items():
+        elapsed, loaded = cold_start(snippet, runs)
+        print(f"{name:18s} {elapsed * 1000:7.1f} ms  loads: {', '.join(loaded) or '-'}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from engine import KnowledgeBase, KnowledgeGraph, setup_manufacturing_knowledge
+
+def per_call(fn, fact_sets) -> float:
+    start = time.perf_counter()
+    for facts in fact_sets:
+        fn(facts)
+    return (time.perf_counter() - start) / len(fact_sets) * 1e6
+
+def main():
+    kb = KnowledgeBase()
+    setup_manufacturing_knowledge(kb, KnowledgeGraph())
+
+    start = time.perf_counter()
+    compiled = kb.compile()
+    build = time.perf_counter() - start
+
+    vocabulary = list(compiled.lookup_bits)
+    random.seed(0)
+    fact_sets = [random.sample(vocabulary, random.randint(1, 6)) for _ in range(50000)]
+
+    def evaluate(facts):
+        kb.facts = set(facts)
+        return kb.evaluate_rules()
+
+    print(f"vocabulary: {len(vocabulary)} symbols, {len(compiled.lookup_ptr) - 1} distinct results, "
+          f"table built in {build * 1000:.1f} ms")
+    print(f"evaluate_rules:     {per_call(evaluate, fact_sets):6.2f} us/call")
+    print(f"diagnose (index):   {per_call(compiled.diagnose_indexed, fact_sets):6.2f} us/call")
+    print(f"diagnose (lookup):  {per_call(compiled.diagnose, fact_sets):6.2f} us/call")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+import argparse
+import csv
+import json
+import sys
+import time
+from itertools import islice
+from typing import Dict, Iterator, List, Optional, TextIO
+
+import numpy as np
+
+from engine import (KnowledgeBase, KnowledgeGraph, ResultCache, load_rule_pack,
+                    setup_manufacturing_knowledge)
+
+# Headless batch diagnosis: fact sets in as JSON lines or CSV, conclusions
+# out as JSON lines. Only the engine is imported, never PyQt6/matplotlib.
+#
+#   python diagnose.py facts.jsonl > conclusions.jsonl
+#   python diagnose.py --format csv --rules pack.json < facts.csv
+#
+# A JSON line is either a list of facts or an object with "facts" and an
+# optional "id" that is copied to the output. A CSV row lists one fact per
+# cell. Each output line holds the forward-chained conclusions sorted by
+# confidence, like the GUI's analysis, or the single-pass matches with
+# --single-step.
+
+def read_jsonl(stream: TextIO, name: str) -> Iterator[tuple]:
+    for lineno, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            raise SystemExit(f"{name}:{lineno}: {e}")
+        if isinstance(record, dict):
+            record_id, facts = record.get('id'), record.get('facts', [])
+        else:
+            record_id, facts = None, record
+        if not isinstance(facts, list) or not all(isinstance(fact, str) for fact in facts):
+            raise SystemExit(f"{name}:{lineno}: expected a list of facts or an object "
+                             "with a \"facts\" list")
+        yield record_id, facts
+
+def read_csv(stream: TextIO) -> Iterator[tuple]:
+    for row in csv.reader(stream):
+        yield None, [cell.strip() for cell in row if cell.strip()]
+
+def read_inputs(paths: List[str], fmt: Optional[str]) -> Iterator[tuple]:
+    for path in paths or ['-']:
+        path_fmt = fmt or ('csv' if path.lower().endswith('.csv') else 'jsonl')
+        if path == '-':
+            yield from read_csv(sys.stdin) if path_fmt == 'csv' else read_jsonl(sys.stdin, '<stdin>')
+        else:
+            with open(path, newline='', encoding='utf-8') as stream:
+                yield from read_csv(stream) if path_fmt == 'csv' else read_jsonl(stream, path)
+
+class BatchDiagnoser:
+    # Outputs depend only on the asserted facts that some rule tests, so
+    # fact sets are keyed by that subset as a sorted tuple of symbol ids
+    # and finished output lines are memoized per key; only distinct misses
+    # reach the engine, one batch at a time, as symbol id rows that never
+    # turn back into strings. Tuples of ints are dropped from garbage
+    # collector tracking, which sets are not, so a full cache does not slow
+    # every collection down.
+    def __init__(self, kb: KnowledgeBase, chain: bool = True, cache_size: int = 1 << 16):
+        self.compiled = kb.compile()
+        self.chain = chain
+        self.index = {kb.symbol_names[symbol_id]: symbol_id for symbol_id, slots
+                      in kb.condition_index.items() if len(slots)}
+        # Output order is confidence descending, then rule id: rank[pos] is
+        # a rule position's place in it and by_rank the inverse. Each rule's
+        # JSON is encoded once, the first time it fires.
+        confidences = self.compiled.confidences
+        self.by_rank = np.lexsort((np.arange(len(confidences)), -confidences))
+        self.rank = np.empty_like(self.by_rank)
+        self.rank[self.by_rank] = np.arange(len(confidences))
+        self.fragments: Dict[int, str] = {}
+        self.cache = ResultCache(cache_size)
+        self.fact_sets = 0
+
+    def key(self, facts) -> tuple:
+        index = self.index
+        return tuple(sorted({index[fact] for fact in facts if fact in index}))
+
+    def conclusions(self, keys: List[tuple]) -> List[str]:
+        rb = self.compiled
+        match = rb.chain_match if self.chain else rb.match_batch
+        fragments = self.fragments
+        n_rules = max(len(self.rank), 1)
+        lines = []
+        for rows, symbol_ids, n_rows in rb.key_chunks(keys, 4096):
+            row_ptr, positions = match(rows, symbol_ids, n_rows)
+            ranked = np.sort(np.repeat(np.arange(n_rows), np.diff(row_ptr)) * n_rules
+                             + self.rank[positions])
+            positions = self.by_rank[ranked % n_rules].tolist()
+            new = [pos for pos in set(positions) if pos not in fragments]
+            fragments.update(zip(new, map(json.dumps, rb.results(new))))
+            bounds = row_ptr.tolist()
+            lines.extend('[' + ', '.join([fragments[pos] for pos in positions[start:end]]) + ']'
+                         for start, end in zip(bounds, bounds[1:]))
+        return lines
+
+    def run(self, records: List[tuple]) -> List[str]:
+        keys = [self.key(facts) for _, facts in records]
+        cached: Dict[tuple, str] = {}
+        missing = []
+        for key in keys:
+            if key in cached:
+                continue
+            entry = self.cache.get(key)
+            if entry is None:
+                missing.append(key)
+                cached[key] = ''
+            else:
+                cached[key] = entry[1]
+        for key, conclusions in zip(missing, self.conclusions(missing)):
+            self.cache.put(key, key, conclusions)
+            cached[key] = conclusions
+        self.fact_sets += len(records)
+        return [f'{{"conclusions": {cached[key]}}}\n' if record_id is None else
+                f'{{"id": {json.dumps(record_id)}, "conclusions": {cached[key]}}}\n'
+                for (record_id, _), key in zip(records, keys)]
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Batch manufacturing diagnosis")
+    parser.add_argument('inputs', nargs='*', help="fact set files, '-' or none for stdin")
+    parser.add_argument('--format', choices=('jsonl', 'csv'),
+                        help="input format (default: by file extension, jsonl for stdin)")
+    parser.add_argument('--rules', help="JSON or CSV rule pack (default: built-in rules)")
+    parser.add_argument('--output', '-o', help="output file (default: stdout)")
+    parser.add_argument('--batch-size', type=int, default=20000)
+    parser.add_argument('--single-step', action='store_true',
+                        help="report direct matches only, without forward chaining")
+    args = parser.parse_args(argv)
+
+    if args.rules:
+        try:
+            kb, _ = load_rule_pack(args.rules)
+        except (OSError, ValueError) as e:
+            raise SystemExit(f"{args.rules}: {e}")
+    else:
+        kb = KnowledgeBase()
+        setup_manufacturing_knowledge(kb, KnowledgeGraph())
+    diagnoser = BatchDiagnoser(kb, chain=not args.single_step)
+
+    out = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    start = time.perf_counter()
+    try:
+        records = read_inputs(args.inputs, args.format)
+        while True:
+            batch = list(islice(records, args.batch_size))
+            if not batch:
+                break
+            out.writelines(diagnoser.run(batch))
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    elapsed = time.perf_counter() - start
+    stats = diagnoser.cache.stats()
+    print(f"{diagnoser.fact_sets} fact sets in {elapsed:.2f} s "
+          f"({diagnoser.fact_sets / max(elapsed, 1e-9):.0f}/s), "
+          f"{stats['misses']} distinct evaluated", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,2599 @@
+import os
+import sys
+import csv
+import time
+import hashlib
+import json
+import math
+import marshal
+import mmap
+import sqlite3
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, islice
+import numpy as np
+import heapq
+from array import array
+from collections.abc import Mapping, Sequence
+from types import MappingProxyType
+from typing import Dict, Iterable, Iterator, List, Optional, Set
+
+# Headless diagnosis engine. Nothing here imports a GUI toolkit; networkx
+# is only imported once a KnowledgeGraph is queried or plotted.
+
+# On-disk cache for generated rule code and other compiled artifacts.
+RULE_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'eng')
+# Bumped whenever the parsed rule pack cache layout changes.
+PACK_CACHE_VERSION = 1
+# Cache entries of each kind kept by prune_cache, most recently used first.
+RULE_CACHE_KEEP = 8
+
+def touch_cache(path: str):
+    # Marks a cache entry as used, so prune_cache keeps it longest.
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+def prune_cache(cache_dir: str, prefix: str, keep: int = RULE_CACHE_KEEP):
+    # Deletes all but the `keep` most recently used `prefix*.bin` entries.
+    # Every edit of a watched pack produces a new content hash, so without
+    # this each reload would leave another multi-MB file behind.
+    entries = []
+    try:
+        for entry in os.scandir(cache_dir):
+            if entry.name.startswith(prefix) and entry.name.endswith('.bin'):
+                try:
+                    entries.append((entry.stat().st_mtime_ns, entry.path))
+                except OSError:
+                    pass
+    except OSError:
+        return
+    entries.sort(reverse=True)
+    for _, path in entries[keep:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+class ReteNode:
+    def __init__(self, condition, parent):
+        self.condition = condition
+        self.parent = parent
+        self.children: List['ReteNode'] = []
+        self.rule_ids: List[int] = []
+        self.active = parent is None
+
+class ReteNetwork:
+    # Propositional Rete: each beta node joins its parent's partial match
+    # with one alpha test, so rules sharing a condition prefix share nodes
+    # and the active flags cache partial matches across fact changes.
+    def __init__(self):
+        self.root = ReteNode(None, None)
+        self.beta: Dict[tuple, ReteNode] = {(): self.root}
+        # condition -> beta nodes testing it
+        self.alpha: Dict[str, List[ReteNode]] = {}
+        self.facts: Set[str] = set()
+        self.fired: Set[int] = set()
+        # rule id -> the beta node it terminates at
+        self.terminals: Dict[int, ReteNode] = {}
+
+    def add_rule(self, rule_id: int, conditions: List[str]):
+        node = self.root
+        key = ()
+        for cond in dict.fromkeys(conditions):
+            key += (cond,)
+            child = self.beta.get(key)
+            if child is None:
+                child = ReteNode(cond, node)
+                child.active = node.active and cond in self.facts
+                node.children.append(child)
+                self.beta[key] = child
+                self.alpha.setdefault(cond, []).append(child)
+            node = child
+        node.rule_ids.append(rule_id)
+        self.terminals[rule_id] = node
+        if node.active:
+            self.fired.add(rule_id)
+
+    def remove_rule(self, rule_id: int):
+        # Shared beta nodes stay in place; only the terminal entry goes.
+        node = self.terminals.pop(rule_id)
+        node.rule_ids.remove(rule_id)
+        self.fired.discard(rule_id)
+
+    def assert_fact(self, fact: str):
+        if fact in self.facts:
+            return
+        self.facts.add(fact)
+        for node in self.alpha.get(fact, ()):
+            if node.parent.active and not node.active:
+                self.activate(node)
+
+    def retract_fact(self, fact: str):
+        if fact not in self.facts:
+            return
+        self.facts.discard(fact)
+        for node in self.alpha.get(fact, ()):
+            if node.active:
+                self.deactivate(node)
+
+    def activate(self, node: ReteNode):
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            node.active = True
+            self.fired.update(node.rule_ids)
+            stack.extend(child for child in node.children
+                         if child.condition in self.facts)
+
+    def deactivate(self, node: ReteNode):
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            node.active = False
+            self.fired.difference_update(node.rule_ids)
+            stack.extend(child for child in node.children if child.active)
+
+class RuleStore(Mapping):
+    # Columnar rule storage. Each rule version occupies a slot: slot k's
+    # condition symbol ids are cond_ids[cond_ptr[k]:cond_ptr[k + 1]] in
+    # declared order and order_ids holds the same slices sorted rarest-first;
+    # conclusions and confidences are flat arrays. Rule ids are assigned
+    # monotonically and map to their current slot through slot_of; removing
+    # or updating a rule only tombstones its old slot, so ids never collide.
+    # compact() drops tombstoned slots, renumbering slots but never ids.
+    # Indexing by rule id builds the rule dict on the fly, so the store
+    # doubles as the read-only `rules` view of a KnowledgeBase.
+    def __init__(self, symbol_names: List[str]):
+        self.symbol_names = symbol_names
+        self.cond_ptr = array('q', [0])
+        self.cond_ids = array('i')
+        self.order_ids = array('i')
+        self.conclusion_ids = array('i')
+        self.confidences = array('d')
+        # slot -> rule id (-1 once tombstoned), rule id -> slot (-1 if removed)
+        self.slot_ids = array('q')
+        self.slot_of = array('q')
+        self.live = 0
+
+    def append(self, cond_ids: List[int], order_ids: List[int], conclusion_id: int,
+               confidence: float, rule_id: Optional[int] = None) -> int:
+        slot = len(self.conclusion_ids)
+        if rule_id is None:
+            rule_id = len(self.slot_of)
+            self.slot_of.append(slot)
+        else:
+            self.slot_of[rule_id] = slot
+        self.cond_ids.extend(cond_ids)
+        self.order_ids.extend(order_ids)
+        self.cond_ptr.append(len(self.cond_ids))
+        self.conclusion_ids.append(conclusion_id)
+        self.confidences.append(confidence)
+        self.slot_ids.append(rule_id)
+        self.live += 1
+        return slot
+
+    def extend(self, cond_ends, cond_ids, order_ids, conclusion_ids, confidences) -> int:
+        # Bulk append of new rules; cond_ends are the end offsets of each
+        # rule's slice within cond_ids. Returns the first new slot.
+        first_slot = len(self.conclusion_ids)
+        first_id = len(self.slot_of)
+        n = len(conclusion_ids)
+        offset = len(self.cond_ids)
+        self.cond_ptr.frombytes((np.asarray(cond_ends, dtype=np.int64) + offset).tobytes())
+        self.cond_ids.frombytes(np.asarray(cond_ids, dtype=np.int32).tobytes())
+        self.order_ids.frombytes(np.asarray(order_ids, dtype=np.int32).tobytes())
+        self.conclusion_ids.frombytes(np.asarray(conclusion_ids, dtype=np.int32).tobytes())
+        self.confidences.frombytes(np.asarray(confidences, dtype=np.float64).tobytes())
+        self.slot_ids.frombytes(np.arange(first_id, first_id + n, dtype=np.int64).tobytes())
+        self.slot_of.frombytes(np.arange(first_slot, first_slot + n, dtype=np.int64).tobytes())
+        self.live += n
+        return first_slot
+
+    def slot(self, rule_id: int) -> int:
+        if not isinstance(rule_id, int) or not 0 <= rule_id < len(self.slot_of) \
+                or self.slot_of[rule_id] < 0:
+            raise KeyError(rule_id)
+        return self.slot_of[rule_id]
+
+    def remove(self, rule_id: int) -> int:
+        slot = self.slot(rule_id)
+        self.slot_ids[slot] = -1
+        self.slot_of[rule_id] = -1
+        self.live -= 1
+        return slot
+
+    def alive(self, slot: int) -> bool:
+        return self.slot_ids[slot] >= 0
+
+    def dead(self) -> int:
+        return len(self.slot_ids) - self.live
+
+    def compact(self) -> np.ndarray:
+        # Returns the old slot -> new slot map, -1 for dropped slots.
+        slot_ids = np.array(self.slot_ids, dtype=np.int64)
+        alive = slot_ids >= 0
+        remap = np.full(len(slot_ids), -1, dtype=np.int64)
+        remap[alive] = np.arange(np.count_nonzero(alive))
+        cond_ptr = np.array(self.cond_ptr, dtype=np.int64)
+        sizes = np.diff(cond_ptr)
+        kept = np.repeat(alive, sizes)
+        self.cond_ids = array('i', np.array(self.cond_ids, dtype=np.int32)[kept].tobytes())
+        self.order_ids = array('i', np.array(self.order_ids, dtype=np.int32)[kept].tobytes())
+        self.cond_ptr = array('q', np.concatenate(([0], np.cumsum(sizes[alive]))).astype(np.int64).tobytes())
+        self.conclusion_ids = array('i', np.array(self.conclusion_ids, dtype=np.int32)[alive].tobytes())
+        self.confidences = array('d', np.array(self.confidences, dtype=np.float64)[alive].tobytes())
+        self.slot_ids = array('q', slot_ids[alive].tobytes())
+        slot_of = np.array(self.slot_of, dtype=np.int64)
+        self.slot_of = array('q', np.where(slot_of >= 0, remap[slot_of], -1).tobytes())
+        return remap
+
+    def live_slots(self) -> Iterator[int]:
+        # in rule id order
+        return (slot for slot in self.slot_of if slot >= 0)
+
+    def conditions(self, slot: int) -> array:
+        return self.cond_ids[self.cond_ptr[slot]:self.cond_ptr[slot + 1]]
+
+    def ordered_conditions(self, slot: int) -> array:
+        return self.order_ids[self.cond_ptr[slot]:self.cond_ptr[slot + 1]]
+
+    def size(self, slot: int) -> int:
+        return self.cond_ptr[slot + 1] - self.cond_ptr[slot]
+
+    def result(self, slot: int) -> Dict:
+        return {
+            'conclusion': self.symbol_names[self.conclusion_ids[slot]],
+            'confidence': self.confidences[slot],
+            'rule_id': self.slot_ids[slot]
+        }
+
+    def __getitem__(self, rule_id: int) -> Dict:
+        slot = self.slot(rule_id)
+        return {
+            'conditions': [self.symbol_names[s] for s in self.conditions(slot)],
+            'conclusion': self.symbol_names[self.conclusion_ids[slot]],
+            'confidence': self.confidences[slot]
+        }
+
+    def __iter__(self) -> Iterator[int]:
+        return (rule_id for rule_id, slot in enumerate(self.slot_of) if slot >= 0)
+
+    def __len__(self) -> int:
+        return self.live
+
+class MappedSymbols(Mapping):
+    # Symbol name -> id table of a mapped rulebase file. Names stay encoded
+    # in the mapping: lookups binary-search the name-sorted order saved with
+    # the file and are memoized, so opening a file decodes no symbols.
+    MAX_FOUND = 1 << 16
+
+    def __init__(self, blob: memoryview, bounds: memoryview, order: memoryview):
+        self.blob = blob
+        self.bounds = bounds
+        self.order = order
+        # symbol -> id, or None for names not in the table
+        self.found: Dict[str, Optional[int]] = {}
+
+    def name(self, symbol_id: int) -> bytes:
+        return bytes(self.blob[self.bounds[symbol_id]:self.bounds[symbol_id + 1]])
+
+    def search(self, symbol: str) -> Optional[int]:
+        if not isinstance(symbol, str):
+            return None
+        key = symbol.encode()
+        order = self.order
+        lo, hi = 0, len(order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.name(order[mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(order) and self.name(order[lo]) == key:
+            return order[lo]
+        return None
+
+    def get(self, symbol, default=None):
+        try:
+            symbol_id = self.found[symbol]
+        except KeyError:
+            symbol_id = self.search(symbol)
+            if len(self.found) >= self.MAX_FOUND:
+                self.found.clear()
+            self.found[symbol] = symbol_id
+        return default if symbol_id is None else symbol_id
+
+    def __getitem__(self, symbol: str) -> int:
+        symbol_id = self.get(symbol)
+        if symbol_id is None:
+            raise KeyError(symbol)
+        return symbol_id
+
+    def __iter__(self) -> Iterator[str]:
+        return (self.name(i).decode() for i in range(len(self)))
+
+    def __len__(self) -> int:
+        return len(self.bounds) - 1
+
+class MappedNames(Sequence):
+    # Symbol id -> name view over the same mapped bytes, decoded on access.
+    def __init__(self, symbols: MappedSymbols):
+        self.symbols = symbols
+
+    def __getitem__(self, symbol_id):
+        if isinstance(symbol_id, slice):
+            return [self[i] for i in range(*symbol_id.indices(len(self)))]
+        if symbol_id < 0:
+            symbol_id += len(self)
+        if not 0 <= symbol_id < len(self):
+            raise IndexError(symbol_id)
+        return self.symbols.name(symbol_id).decode()
+
+    def __len__(self) -> int:
+        return len(self.symbols)
+
+class CompiledRulebase:
+    # Read-only snapshot of a KnowledgeBase's rules. It holds no session
+    # state and is never mutated after construction, so one instance can
+    # serve diagnose() calls from many threads at once, and back any number
+    # of DiagnosisSession objects.
+    LOOKUP_MAX_SYMBOLS = 20
+    LOOKUP_MAX_RESULTS = 1 << 16
+    # caps on the rule positions stored over all distinct outcomes, and on
+    # outcomes x distinct condition masks compared while building them
+    LOOKUP_MAX_POSITIONS = 1 << 20
+    LOOKUP_MAX_WORK = 1 << 26
+    # cap on (row, rule) pairs expanded per batch chunk, to bound memory
+    BATCH_MAX_PAIRS = 1 << 21
+    # Binary file layout: fixed header (magic, format version, section
+    # count, source digest, crc32 of everything after the header), then a
+    # section table (name, dtype, offset, length) and 8-byte aligned arrays.
+    FILE_MAGIC = b'ENGRULES'
+    FILE_VERSION = 2
+    FILE_HEADER = struct.Struct('<8sII32sI')
+    FILE_SECTION = struct.Struct('<16s8sQQ')
+    FILE_ARRAYS = ('rule_ids', 'conclusion_ids', 'confidences', 'indptr', 'indices', 'needed')
+
+    def __init__(self, kb: 'KnowledgeBase', lookup_max_symbols: Optional[int] = None):
+        # Live rules are laid out by position in rule id order; the store's
+        # tombstoned slots are dropped here.
+        store = kb.rules
+        self.symbols = MappingProxyType(dict(kb.symbols))
+        self.symbol_names = tuple(kb.symbol_names)
+        slot_of = np.array(store.slot_of, dtype=np.int64)
+        self.rule_ids = np.flatnonzero(slot_of >= 0)
+        slots = slot_of[self.rule_ids]
+        position_of = np.full(len(store.slot_ids), -1, dtype=np.int64)
+        position_of[slots] = np.arange(len(slots))
+        self.conclusion_ids = np.array(store.conclusion_ids, dtype=np.int32)[slots]
+        self.confidences = np.array(store.confidences, dtype=np.float64)[slots]
+        sizes = np.diff(np.array(store.cond_ptr, dtype=np.int64))[slots]
+        # Sparse symbols x rules incidence in CSR form, rule positions sorted
+        # per symbol. Row n_symbols is a pseudo-symbol present in every fact
+        # set that carries the rules without conditions, so those need one
+        # hit like any single-condition rule.
+        self.n_symbols = len(self.symbol_names)
+        counts = np.zeros(self.n_symbols + 1, dtype=np.int64)
+        rows = []
+        for symbol_id in sorted(kb.condition_index):
+            positions = position_of[np.array(kb.condition_index[symbol_id], dtype=np.int64)]
+            rows.append(np.sort(positions[positions >= 0]))
+            counts[symbol_id] = len(rows[-1])
+        rows.append(np.flatnonzero(sizes == 0))
+        counts[self.n_symbols] = len(rows[-1])
+        self.indptr = np.zeros(self.n_symbols + 2, dtype=np.int64)
+        np.cumsum(counts, out=self.indptr[1:])
+        self.indices = np.concatenate(rows)
+        self.needed = np.maximum(sizes, 1).astype(np.int32)
+        # Small condition vocabularies get a precomputed table with one entry
+        # per possible fact combination; larger ones, or ones with too many
+        # distinct outcomes to store, fall back to the index.
+        vocabulary = np.flatnonzero(counts[:self.n_symbols]).tolist()
+        if lookup_max_symbols is None:
+            lookup_max_symbols = self.LOOKUP_MAX_SYMBOLS
+        self.lookup_bits = None
+        self.lookup_table = None
+        self.lookup_ptr = None
+        self.lookup_positions = None
+        self.lookup_cache: Dict[int, tuple] = {}
+        self.strata_cache = None
+        if len(vocabulary) <= lookup_max_symbols:
+            self.build_lookup_table(kb, vocabulary)
+        self.freeze()
+
+    def build_lookup_table(self, kb: 'KnowledgeBase', vocabulary: List[int]):
+        # Give every distinct condition mask a random 64-bit tag and sum the
+        # tags of all masks that are a subset of each table index (a
+        # subset-sum transform, n passes over 2^n entries); rule counts go
+        # through the same transform. Equal sums mean equal fired sets, so
+        # np.unique collapses the table to ids of distinct outcomes, and the
+        # counts size the outcomes' CSR rows of rule positions before any of
+        # them is built.
+        n = len(vocabulary)
+        dense = np.zeros(len(self.needed), dtype=np.int64)
+        for bit, symbol_id in enumerate(vocabulary):
+            dense[self.indices[self.indptr[symbol_id]:self.indptr[symbol_id + 1]]] |= 1 << bit
+        masks, groups = np.unique(dense, return_inverse=True)
+        sizes = np.bincount(groups, minlength=len(masks))
+        sums = np.zeros(1 << n, dtype=np.uint64)
+        sums[masks] = np.random.default_rng(0).integers(1, 2**63, size=len(masks), dtype=np.uint64)
+        counts = np.zeros(1 << n, dtype=np.int64)
+        counts[masks] = sizes
+        for bit in range(n):
+            step = 1 << bit
+            for column in (sums, counts):
+                pairs = column.reshape(-1, 2 * step)
+                pairs[:, step:] += pairs[:, :step]
+        distinct, representative, table = np.unique(sums, return_index=True, return_inverse=True)
+        if len(distinct) > self.LOOKUP_MAX_RESULTS \
+                or counts[representative].sum() > self.LOOKUP_MAX_POSITIONS \
+                or len(distinct) * len(masks) > self.LOOKUP_MAX_WORK:
+            return
+        # (outcome, position) pairs for every mask group an outcome's
+        # representative mask contains, sorted into CSR rows
+        n_rules = max(len(dense), 1)
+        members = np.argsort(groups, kind='stable')
+        bounds = np.concatenate(([0], np.cumsum(sizes))).tolist()
+        keys = [(np.flatnonzero(representative & mask == mask)[:, None] * n_rules
+                 + members[start:end]).ravel()
+                for mask, start, end in zip(masks.tolist(), bounds, bounds[1:])]
+        keys = np.sort(np.concatenate(keys)) if keys else np.zeros(0, dtype=np.int64)
+        self.lookup_ptr = np.zeros(len(distinct) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(keys // n_rules, minlength=len(distinct)), out=self.lookup_ptr[1:])
+        self.lookup_positions = keys % n_rules
+        self.lookup_table = table.astype(np.min_scalar_type(len(distinct)))
+        self.lookup_bits = MappingProxyType({kb.symbol_names[symbol_id]: bit
+                                             for bit, symbol_id in enumerate(vocabulary)})
+
+    def lookup_results(self, outcome: int) -> tuple:
+        # Result tuples of one table outcome, built on first use.
+        results = self.lookup_cache.get(outcome)
+        if results is None:
+            start, end = self.lookup_ptr[outcome], self.lookup_ptr[outcome + 1]
+            results = tuple((r['conclusion'], r['confidence'], r['rule_id'])
+                            for r in self.results(self.lookup_positions[start:end]))
+            self.lookup_cache[outcome] = results
+        return results
+
+    def strata(self) -> np.ndarray:
+        # Same as KnowledgeBase.strata, from the CSR rows; computed on first
+        # use, and only ever replaced by an identical array.
+        if self.strata_cache is None:
+            n = self.n_symbols
+            sources = np.repeat(np.arange(n), np.diff(self.indptr[:n + 1]))
+            targets = self.conclusion_ids[self.indices[:self.indptr[n]]]
+            self.strata_cache = symbol_strata(n, sources, targets)
+        return self.strata_cache
+
+    def freeze(self):
+        for name in self.FILE_ARRAYS + ('lookup_table', 'lookup_ptr', 'lookup_positions'):
+            array = getattr(self, name)
+            if array is not None and array.flags.writeable:
+                array.flags.writeable = False
+
+    def save(self, path: str, digest: bytes = b''):
+        sections = {name: getattr(self, name) for name in self.FILE_ARRAYS}
+        encoded = [name.encode() for name in self.symbol_names]
+        sections['symbol_ptr'] = np.concatenate([[0], np.cumsum([len(e) for e in encoded])]).astype(np.int64)
+        sections['symbol_bytes'] = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        sections['symbol_order'] = np.array(sorted(range(len(encoded)), key=encoded.__getitem__),
+                                            dtype=np.int64)
+        if self.lookup_table is not None:
+            sections['lookup_vocab'] = np.array([self.symbols[name] for name in self.lookup_bits],
+                                                dtype=np.int64)
+            sections['lookup_table'] = self.lookup_table
+            sections['lookup_ptr'] = self.lookup_ptr
+            sections['lookup_positions'] = self.lookup_positions
+        offset = self.FILE_HEADER.size + self.FILE_SECTION.size * len(sections)
+        table, chunks = [], []
+        for name, data in sections.items():
+            data = np.ascontiguousarray(data)
+            padding = -offset % 8
+            chunks.append(b'\0' * padding)
+            offset += padding
+            table.append(self.FILE_SECTION.pack(name.encode(), data.dtype.str.encode(),
+                                                offset, data.nbytes))
+            chunks.append(data.tobytes())
+            offset += data.nbytes
+        body = b''.join(table + chunks)
+        header = self.FILE_HEADER.pack(self.FILE_MAGIC, self.FILE_VERSION, len(sections),
+                                       digest.ljust(32, b'\0'), zlib.crc32(body))
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(header)
+            f.write(body)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, digest: Optional[bytes] = None,
+             verify: bool = False) -> 'CompiledRulebase':
+        # Maps the file read-only; the arrays are views into the page cache,
+        # so every process opening the same file shares one copy, and
+        # symbols are decoded lazily. Raises ValueError for a wrong version,
+        # a truncated body, a checksum mismatch when verify is set (the
+        # crc32 reads the whole file; only callers mapping a file that was
+        # already verified, like pool workers, skip it) or, when a digest is
+        # given, a file compiled from another rulebase.
+        with open(path, 'rb') as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(mapping) < cls.FILE_HEADER.size:
+            raise ValueError(f"Truncated rulebase file: {path}")
+        magic, version, n_sections, file_digest, checksum = cls.FILE_HEADER.unpack_from(mapping)
+        if magic != cls.FILE_MAGIC or version != cls.FILE_VERSION:
+            raise ValueError(f"Unsupported rulebase file: {path}")
+        if digest is not None and file_digest != digest.ljust(32, b'\0'):
+            raise ValueError(f"Rulebase file is stale: {path}")
+        if len(mapping) < cls.FILE_HEADER.size + n_sections * cls.FILE_SECTION.size:
+            raise ValueError(f"Truncated rulebase file: {path}")
+        if verify and zlib.crc32(memoryview(mapping)[cls.FILE_HEADER.size:]) != checksum:
+            raise ValueError(f"Rulebase file checksum mismatch: {path}")
+        sections = {}
+        views = {}
+        for i in range(n_sections):
+            name, dtype, offset, nbytes = cls.FILE_SECTION.unpack_from(
+                mapping, cls.FILE_HEADER.size + i * cls.FILE_SECTION.size)
+            if offset + nbytes > len(mapping):
+                raise ValueError(f"Truncated rulebase file: {path}")
+            name = name.rstrip(b'\0').decode()
+            dtype = np.dtype(dtype.rstrip(b'\0').decode())
+            sections[name] = np.frombuffer(mapping, dtype=dtype, count=nbytes // dtype.itemsize,
+                                           offset=offset)
+            views[name] = memoryview(mapping)[offset:offset + nbytes]
+        self = cls.__new__(cls)
+        self.mapping = mapping
+        for name in cls.FILE_ARRAYS:
+            setattr(self, name, sections[name])
+        self.symbols = MappedSymbols(views['symbol_bytes'], views['symbol_ptr'].cast('q'),
+                                     views['symbol_order'].cast('q'))
+        self.symbol_names = MappedNames(self.symbols)
+        self.n_symbols = len(self.symbol_names)
+        self.lookup_bits = None
+        self.lookup_table = None
+        self.lookup_ptr = None
+        self.lookup_positions = None
+        self.lookup_cache = {}
+        self.strata_cache = None
+        if 'lookup_table' in sections:
+            self.lookup_bits = MappingProxyType({self.symbol_names[symbol_id]: bit for bit, symbol_id
+                                                 in enumerate(sections['lookup_vocab'].tolist())})
+            for name in ('lookup_table', 'lookup_ptr', 'lookup_positions'):
+                setattr(self, name, sections[name])
+        return self
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.pop('mapping', None)
+        state['lookup_cache'] = {}
+        state['symbol_names'] = tuple(self.symbol_names)
+        state['symbols'] = {name: i for i, name in enumerate(state['symbol_names'])}
+        if self.lookup_bits is not None:
+            state['lookup_bits'] = dict(self.lookup_bits)
+        return state
+
+    def __setstate__(self, state):
+        state['symbols'] = MappingProxyType(state['symbols'])
+        if state['lookup_bits'] is not None:
+            state['lookup_bits'] = MappingProxyType(state['lookup_bits'])
+        self.__dict__.update(state)
+        self.freeze()
+
+    def diagnose(self, facts) -> List[Dict]:
+        if self.lookup_table is not None:
+            mask = 0
+            for fact in facts:
+                bit = self.lookup_bits.get(fact)
+                if bit is not None:
+                    mask |= 1 << bit
+            return [{'conclusion': conclusion, 'confidence': confidence, 'rule_id': rule_id}
+                    for conclusion, confidence, rule_id
+                    in self.lookup_results(int(self.lookup_table[mask]))]
+        return self.diagnose_indexed(facts)
+
+    def diagnose_indexed(self, facts) -> List[Dict]:
+        hits = {}
+        for fact in set(facts):
+            symbol_id = self.symbols.get(fact)
+            if symbol_id is None:
+                continue
+            for pos in self.indices[self.indptr[symbol_id]:self.indptr[symbol_id + 1]].tolist():
+                hits[pos] = hits.get(pos, 0) + 1
+        fired = self.indices[self.indptr[self.n_symbols]:].tolist()
+        fired.extend(pos for pos, count in hits.items() if count == self.needed[pos])
+        return self.results(sorted(fired))
+
+    def results(self, positions) -> List[Dict]:
+        positions = np.asarray(positions, dtype=np.int64)
+        names = self.symbol_names
+        return [{'conclusion': names[conclusion_id], 'confidence': confidence, 'rule_id': rule_id}
+                for conclusion_id, confidence, rule_id in zip(
+                    self.conclusion_ids[positions].tolist(),
+                    self.confidences[positions].tolist(),
+                    self.rule_ids[positions].tolist())]
+
+    def diagnose_batch(self, fact_sets, chunk_size: int = 4096) -> List[List[Dict]]:
+        # Evaluate many fact sets at once. fact_sets is either an iterable of
+        # string collections or an N x n_symbols boolean matrix whose columns
+        # follow the symbol ids. Each row's hits are found by expanding its
+        # facts through the CSR incidence and counting (row, rule) pairs, so
+        # the cost follows the number of asserted facts rather than
+        # rules x indicators.
+        results = []
+        for row_ptr, positions in self.match_chunks(fact_sets, chunk_size):
+            results.extend(self.expand(row_ptr, positions))
+        return results
+
+    def chain_batch(self, fact_sets, chunk_size: int = 4096) -> List[List[Dict]]:
+        # Forward chaining over many fact sets; each row lists every rule
+        # that fired, in rule id order.
+        results = []
+        for rows, symbol_ids, n_rows in self.batch_chunks(fact_sets, chunk_size):
+            results.extend(self.expand(*self.chain_match(rows, symbol_ids, n_rows)))
+        return results
+
+    def chain_match(self, rows, symbol_ids, n_rows: int) -> tuple:
+        # match_batch with forward chaining: rows whose fired conclusions
+        # add facts are matched again with them until none grow. Facts only
+        # grow, so a row's last round holds every rule it fired. Facts are
+        # kept as sorted row * n_symbols + symbol id keys.
+        n_symbols = max(self.n_symbols, 1)
+        n_rules = max(len(self.needed), 1)
+        known = tally(np.asarray(rows, dtype=np.int64) * n_symbols + symbol_ids)[0]
+        active = np.arange(n_rows)
+        local = np.full(n_rows, -1, dtype=np.int64)
+        finished = []
+        while len(active):
+            local[active] = np.arange(len(active))
+            known_rows = local[known // n_symbols]
+            current = known_rows >= 0
+            row_ptr, positions = self.match_batch(known_rows[current], known[current] % n_symbols,
+                                                  len(active))
+            local[active] = -1
+            fired_rows = np.repeat(active, np.diff(row_ptr))
+            derived = tally(fired_rows * n_symbols + self.conclusion_ids[positions])[0]
+            derived = derived[~np.isin(derived, known, assume_unique=True)]
+            active = tally(derived // n_symbols)[0]
+            done = ~np.isin(fired_rows, active)
+            finished.append(fired_rows[done] * n_rules + positions[done])
+            known = np.sort(np.concatenate([known, derived]))
+        keys = np.sort(np.concatenate(finished))
+        row_ptr = np.zeros(n_rows + 1, dtype=np.int64)
+        np.cumsum(np.bincount(keys // n_rules, minlength=n_rows), out=row_ptr[1:])
+        return row_ptr, keys % n_rules
+
+    def match_chunks(self, fact_sets, chunk_size: int = 4096):
+        # Yields (row_ptr, positions) per chunk: the fired rule positions of
+        # row i are positions[row_ptr[i]:row_ptr[i + 1]], in rule id order.
+        if isinstance(fact_sets, np.ndarray):
+            chunks = self.matrix_chunks(fact_sets[:, :self.n_symbols], chunk_size)
+        else:
+            chunks = self.batch_chunks(fact_sets, chunk_size)
+        for rows, symbol_ids, n_rows in chunks:
+            yield self.match_batch(rows, symbol_ids, n_rows)
+
+    def expand(self, row_ptr: np.ndarray, positions: np.ndarray) -> List[List[Dict]]:
+        results = self.results(positions)
+        bounds = row_ptr.tolist()
+        return [results[start:end] for start, end in zip(bounds, bounds[1:])]
+
+    def matrix_chunks(self, matrix: np.ndarray, chunk_size: int):
+        for start in range(0, len(matrix), chunk_size):
+            chunk = matrix[start:start + chunk_size]
+            rows, symbol_ids = np.nonzero(chunk)
+            yield rows, symbol_ids, len(chunk)
+
+    def batch_chunks(self, fact_sets, chunk_size: int):
+        # Chunks end after chunk_size rows or once the rows' facts expand to
+        # BATCH_MAX_PAIRS (row, rule) pairs, whichever comes first.
+        indptr = self.indptr
+        rows, symbol_ids, n_rows, pairs = [], [], 0, 0
+        for facts in fact_sets:
+            for fact in set(facts):
+                symbol_id = self.symbols.get(fact)
+                if symbol_id is not None:
+                    rows.append(n_rows)
+                    symbol_ids.append(symbol_id)
+                    pairs += indptr[symbol_id + 1] - indptr[symbol_id]
+            n_rows += 1
+            if n_rows == chunk_size or pairs >= self.BATCH_MAX_PAIRS:
+                yield np.array(rows, dtype=np.int64), np.array(symbol_ids, dtype=np.int64), n_rows
+                rows, symbol_ids, n_rows, pairs = [], [], 0, 0
+        if n_rows:
+            yield np.array(rows, dtype=np.int64), np.array(symbol_ids, dtype=np.int64), n_rows
+
+    def key_chunks(self, keys: List[tuple], chunk_size: int):
+        # batch_chunks for rows already given as tuples of distinct symbol
+        # ids, cut at the same limits without a Python pass over the facts.
+        lengths = np.fromiter(map(len, keys), dtype=np.int64, count=len(keys))
+        ends = np.cumsum(lengths)
+        symbol_ids = np.fromiter(chain.from_iterable(keys), dtype=np.int64,
+                                 count=int(ends[-1]) if len(keys) else 0)
+        rows = np.repeat(np.arange(len(keys)), lengths)
+        spans = self.indptr[symbol_ids + 1] - self.indptr[symbol_ids]
+        pairs = np.cumsum(np.bincount(rows, weights=spans, minlength=len(keys)))
+        start = 0
+        while start < len(keys):
+            limit = (pairs[start - 1] if start else 0) + self.BATCH_MAX_PAIRS
+            end = min(start + chunk_size, int(np.searchsorted(pairs, limit)) + 1, len(keys))
+            first, last = (ends[start - 1] if start else 0), ends[end - 1]
+            yield rows[first:last] - start, symbol_ids[first:last], end - start
+            start = end
+
+    def match_batch(self, rows, symbol_ids, n_rows: int) -> tuple:
+        n_rules = len(self.needed)
+        rows = np.concatenate([rows, np.arange(n_rows)])
+        symbol_ids = np.concatenate([symbol_ids, np.full(n_rows, self.n_symbols)])
+        starts = self.indptr[symbol_ids]
+        counts = self.indptr[symbol_ids + 1] - starts
+        total = counts.sum()
+        offsets = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(total)
+        keys = np.repeat(rows, counts) * n_rules + self.indices[offsets]
+        keys, hits = np.unique(keys, return_counts=True)
+        positions = keys % n_rules
+        matched = hits == self.needed[positions]
+        row_ptr = np.zeros(n_rows + 1, dtype=np.int64)
+        np.cumsum(np.bincount(keys[matched] // n_rules, minlength=n_rows), out=row_ptr[1:])
+        return row_ptr, positions[matched]
+
+class GeneratedMatcher:
+    # Turns the rulebase into generated Python: rules are arranged in a trie
+    # over their conditions, rarest condition first, and each top-level
+    # branch becomes one function of nested `in` tests. diagnose() only
+    # calls the functions whose first condition is an asserted fact. The
+    # compiled code object is cached on disk under a hash of the rulebase.
+    CODEGEN_VERSION = 1
+    # stay well below CPython's limit of 20 statically nested blocks
+    MAX_NESTING = 16
+
+    def __init__(self, kb: 'KnowledgeBase', frequencies: Optional[Dict[str, float]] = None,
+                 cache_dir: Optional[str] = RULE_CACHE_DIR):
+        compiled = kb.compile()
+        self.compiled = compiled
+        if frequencies is None and kb.statistics.observations:
+            frequencies = kb.statistics.frequencies()
+        elif frequencies is None:
+            # Without observed statistics, assume indicators that many rules
+            # mention are asserted more often than ones few rules mention.
+            frequencies = {kb.symbol_names[symbol_id]: len(rule_set)
+                           for symbol_id, rule_set in kb.condition_index.items()}
+        rules = []
+        for pos, rule_id in enumerate(compiled.rule_ids.tolist()):
+            conditions = sorted(dict.fromkeys(kb.rules[rule_id]['conditions']),
+                                key=lambda cond: (frequencies.get(cond, 0), cond))
+            rules.append((pos, conditions))
+        self.digest = hashlib.sha256(
+            json.dumps([self.CODEGEN_VERSION, rules]).encode()).hexdigest()
+        self.cache_path = None
+        if cache_dir is not None:
+            self.cache_path = os.path.join(
+                cache_dir, f"rules-{self.digest}.{sys.implementation.cache_tag}.bin")
+        code = self.load_cached()
+        self.cache_hit = code is not None
+        if code is None:
+            code = compile(self.generate(rules), f"<rules {self.digest[:12]}>", 'exec')
+            self.store_cached(code)
+        namespace = {}
+        exec(code, namespace)
+        self.groups = namespace['GROUPS']
+        self.unconditional = namespace['UNCONDITIONAL']
+
+    def generate(self, rules: List[tuple]) -> str:
+        root = {'children': {}, 'rules': []}
+        for pos, conditions in rules:
+            node = root
+            for cond in conditions:
+                node = node['children'].setdefault(cond, {'children': {}, 'rules': []})
+            node['rules'].append(pos)
+        lines = []
+        groups = []
+        for i, (cond, node) in enumerate(root['children'].items()):
+            lines.append(f"def group_{i}(facts, fired):")
+            self.emit(node, 1, lines)
+            groups.append(f"{cond!r}: group_{i}")
+        lines.append(f"GROUPS = {{{', '.join(groups)}}}")
+        lines.append(f"UNCONDITIONAL = {root['rules']!r}")
+        return '\n'.join(lines) + '\n'
+
+    def emit(self, node: Dict, depth: int, lines: List[str]):
+        indent = '    ' * depth
+        for pos in node['rules']:
+            lines.append(f"{indent}fired.append({pos})")
+        for cond, child in node['children'].items():
+            if depth < self.MAX_NESTING:
+                lines.append(f"{indent}if {cond!r} in facts:")
+                self.emit(child, depth + 1, lines)
+                continue
+            # Too deep to nest further: test the rest of each path flat.
+            for path, pos in self.paths(child, [cond]):
+                test = ' and '.join(f"{c!r} in facts" for c in path)
+                lines.append(f"{indent}if {test}:")
+                lines.append(f"{indent}    fired.append({pos})")
+
+    def paths(self, node: Dict, prefix: List[str]):
+        for pos in node['rules']:
+            yield prefix, pos
+        for cond, child in node['children'].items():
+            yield from self.paths(child, prefix + [cond])
+
+    def load_cached(self):
+        if self.cache_path is None:
+            return None
+        try:
+            with open(self.cache_path, 'rb') as f:
+                code = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        touch_cache(self.cache_path)
+        return code
+
+    def store_cached(self, code):
+        if self.cache_path is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                marshal.dump(code, f)
+            os.replace(tmp_path, self.cache_path)
+        except OSError:
+            return
+        prune_cache(os.path.dirname(self.cache_path), 'rules-')
+
+    def diagnose(self, facts) -> List[Dict]:
+        if not isinstance(facts, (set, frozenset)):
+            facts = set(facts)
+        fired = list(self.unconditional)
+        groups = self.groups
+        for fact in facts:
+            group = groups.get(fact)
+            if group is not None:
+                group(facts, fired)
+        return self.compiled.results(sorted(fired))
+
+class FactStatistics:
+    # Running counts of how often each fact is present when rules are
+    # evaluated. Matchers use them to test a rule's rarest condition first.
+    def __init__(self):
+        self.observations = 0
+        self.counts: Dict[str, int] = {}
+
+    def observe(self, facts):
+        self.observations += 1
+        for fact in facts:
+            self.counts[fact] = self.counts.get(fact, 0) + 1
+
+    def frequency(self, fact: str) -> float:
+        if not self.observations:
+            return 0.0
+        return self.counts.get(fact, 0) / self.observations
+
+    def frequencies(self) -> Dict[str, float]:
+        return {fact: self.frequency(fact) for fact in self.counts}
+
+    def order(self, conditions: List[str]) -> tuple:
+        return tuple(sorted(dict.fromkeys(conditions),
+                            key=lambda cond: (self.counts.get(cond, 0), cond)))
+
+    def save(self, path: str):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'observations': self.observations, 'counts': self.counts}, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'FactStatistics':
+        with open(path) as f:
+            data = json.load(f)
+        statistics = cls()
+        statistics.observations = data['observations']
+        statistics.counts = data['counts']
+        return statistics
+
+class ResultCache:
+    # Bounded LRU of analysis results keyed by the asserted symbol ids, as a
+    # frozenset or sorted tuple. Each entry also keeps the ids of everything
+    # known after chaining (facts plus derived conclusions); a new rule can
+    # only change entries whose known ids cover all of its conditions, so
+    # only those are dropped. Keys stay as small as the fact sets however
+    # large the symbol table grows.
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self.entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key) -> Optional[tuple]:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, known, conclusions: List[Dict]):
+        self.entries[key] = (known, conclusions)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, conditions: frozenset):
+        stale = [key for key, (known, _) in self.entries.items() if conditions.issubset(known)]
+        for key in stale:
+            del self.entries[key]
+        self.invalidations += len(stale)
+
+    def clear(self):
+        self.invalidations += len(self.entries)
+        self.entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'invalidations': self.invalidations, 'size': len(self.entries)}
+
+class WindowCount:
+    # Rule condition that holds while `fact` was added at least `at_least`
+    # times within the last `within` seconds. Inside the knowledge base it
+    # is a pseudo-fact named after the predicate.
+    def __init__(self, fact: str, at_least: int, within: float):
+        self.fact = fact
+        self.at_least = at_least
+        self.within = within
+        self.name = f"{fact}[>={at_least} in {within:g}s]"
+
+    @classmethod
+    def rate(cls, fact: str, per_second: float, within: float) -> 'WindowCount':
+        return cls(fact, max(1, math.ceil(per_second * within)), within)
+
+class SequencePattern:
+    # Rule condition that holds for `hold` seconds (default: `within`) once
+    # its steps were added in order, first to last within `within` seconds.
+    # A step is a fact or a tuple of alternative facts; unrelated facts may
+    # occur in between. Like WindowCount it becomes a pseudo-fact.
+    def __init__(self, steps: List, within: float, hold: Optional[float] = None):
+        self.steps = [tuple(step) if isinstance(step, (list, tuple, set, frozenset)) else (step,)
+                      for step in steps]
+        self.within = within
+        self.hold = within if hold is None else hold
+        self.name = '->'.join('|'.join(step) for step in self.steps) + f"[{within:g}s]"
+
+class SequenceMatcher:
+    # NFA for one SequencePattern over a timestamped fact stream. State i means the
+    # first i steps matched. Runs in the same state differ only by start
+    # time and the latest start dominates (it has the most time left), so
+    # one start per state is kept: memory is O(steps) however many partial
+    # matches are in flight.
+    def __init__(self, sequence: SequencePattern):
+        self.sequence = sequence
+        self.starts = [-math.inf] * len(sequence.steps)
+        # fact -> steps it can take, last step first so one event never
+        # advances a run twice
+        self.steps_of: Dict[str, List[int]] = {}
+        for i, step in enumerate(sequence.steps):
+            for fact in step:
+                steps = self.steps_of.setdefault(fact, [])
+                if i not in steps:
+                    steps.insert(0, i)
+
+    def reset(self):
+        self.starts = [-math.inf] * len(self.sequence.steps)
+
+    def advance(self, fact: str, now: float) -> bool:
+        # Feeds one event; True when it completes the sequence.
+        starts = self.starts
+        matched = False
+        for i in self.steps_of[fact]:
+            start = now if i == 0 else starts[i]
+            if start < now - self.sequence.within:
+                continue
+            if i + 1 == len(starts):
+                matched = True
+            elif start > starts[i + 1]:
+                starts[i + 1] = start
+        return matched
+
+def condition_name(condition) -> str:
+    return condition.name if isinstance(condition, (WindowCount, SequencePattern)) else condition
+
+class RingBuffer:
+    # The last `capacity` timestamps of one fact; the oldest is overwritten.
+    def __init__(self, capacity: int):
+        self.times = array('d', [-math.inf]) * capacity
+        self.head = 0
+
+    def push(self, timestamp: float):
+        self.times[self.head] = timestamp
+        self.head = (self.head + 1) % len(self.times)
+
+    def recent(self, k: int) -> float:
+        # k-th most recent timestamp, -inf if there were fewer than k
+        return self.times[(self.head - k) % len(self.times)]
+
+    def grow(self, capacity: int):
+        if capacity > len(self.times):
+            ordered = self.times[self.head:] + self.times[:self.head]
+            self.times = array('d', [-math.inf]) * (capacity - len(ordered)) + ordered
+            self.head = 0
+
+class TimingWheel:
+    # Hierarchical timing wheel. Time is cut into ticks of `resolution`
+    # seconds; level l has 2**bits buckets covering 2**(bits * l) ticks
+    # each, addressed by the due tick's bits. Scheduling is O(1), and each
+    # tick only empties one level-0 bucket, cascading a higher-level bucket
+    # down when the level below wraps, so an entry moves at most `levels`
+    # times before it expires.
+    def __init__(self, start: float, resolution: float = 0.1, bits: int = 8, levels: int = 4):
+        self.resolution = resolution
+        self.bits = bits
+        self.mask = (1 << bits) - 1
+        self.levels = levels
+        self.buckets = [[[] for _ in range(1 << bits)] for _ in range(levels)]
+        self.tick = math.floor(start / resolution)
+        self.size = 0
+
+    def schedule(self, deadline: float, item):
+        self.place(max(math.ceil(deadline / self.resolution), self.tick + 1), item)
+        self.size += 1
+
+    def place(self, due: int, item):
+        # level = number of bit groups by which due and the current tick
+        # differ, so bucket (due >> bits * level) is visited on the way down
+        level = min(max(((due ^ self.tick).bit_length() - 1) // self.bits, 0), self.levels - 1)
+        self.buckets[level][due >> self.bits * level & self.mask].append((due, item))
+
+    def advance(self, now: float) -> List:
+        # Items due at or before now, in due order.
+        target = math.floor(now / self.resolution)
+        expired = []
+        if not self.size:
+            self.tick = max(self.tick, target)
+            return expired
+        while self.tick < target and self.size:
+            self.tick += 1
+            tick = self.tick
+            level = 1
+            while level < self.levels and not tick & ((1 << self.bits * level) - 1):
+                level += 1
+            for lower in range(level - 1, 0, -1):
+                bucket = self.buckets[lower][tick >> self.bits * lower & self.mask]
+                self.buckets[lower][tick >> self.bits * lower & self.mask] = []
+                for due, item in bucket:
+                    self.place(due, item)
+            bucket = self.buckets[0][tick & self.mask]
+            if bucket:
+                self.buckets[0][tick & self.mask] = []
+                self.size -= len(bucket)
+                expired.extend(item for _, item in bucket)
+        self.tick = max(self.tick, target)
+        return expired
+
+def adjacency(n_nodes: int, sources: np.ndarray, targets: np.ndarray) -> tuple:
+    # CSR form of an edge list: row k's targets are targets[indptr[k]:indptr[k + 1]].
+    indptr = np.zeros(n_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=n_nodes), out=indptr[1:])
+    return indptr, targets[np.argsort(sources)]
+
+def successors(indptr: np.ndarray, targets: np.ndarray, nodes: np.ndarray) -> np.ndarray:
+    # Concatenated CSR rows of nodes, gathered without a Python loop.
+    starts = indptr[nodes]
+    counts = indptr[nodes + 1] - starts
+    offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+    return targets[offsets + np.arange(len(offsets))]
+
+def tally(values: np.ndarray) -> tuple:
+    # Sorted distinct values and their counts; sorting beats np.unique's
+    # hashing on the large integer arrays seen here.
+    values = np.sort(values)
+    starts = np.flatnonzero(np.concatenate((values[:1] == values[:1], values[1:] != values[:-1])))
+    return values[starts], np.diff(np.append(starts, len(values)))
+
+def generations(n_nodes: int, sources: np.ndarray, targets: np.ndarray) -> np.ndarray:
+    # Kahn's algorithm one generation at a time: a node's level is its
+    # longest path from a node without incoming edges. Nodes on or
+    # downstream of a cycle are never reached and stay at -1.
+    indptr, targets = adjacency(n_nodes, sources, targets)
+    in_degree = np.bincount(targets, minlength=n_nodes)
+    level = np.full(n_nodes, -1, dtype=np.int64)
+    frontier = np.flatnonzero(in_degree == 0)
+    generation = 0
+    while len(frontier):
+        level[frontier] = generation
+        reached, hits = tally(successors(indptr, targets, frontier))
+        in_degree[reached] -= hits
+        frontier = reached[in_degree[reached] == 0]
+        generation += 1
+    return level
+
+def reachable(indptr: np.ndarray, targets: np.ndarray, start: int) -> np.ndarray:
+    seen = np.zeros(len(indptr) - 1, dtype=bool)
+    seen[start] = True
+    frontier = np.array([start])
+    while len(frontier):
+        reached = tally(successors(indptr, targets, frontier))[0]
+        frontier = reached[~seen[reached]]
+        seen[frontier] = True
+    return seen
+
+def cyclic_core(core: np.ndarray, sources: np.ndarray, targets: np.ndarray) -> np.ndarray:
+    # Drops the nodes of core that are not both reachable from and leading
+    # to a cycle within core; what remains is the union of its cycles and
+    # the paths between them.
+    inner = core[sources] & core[targets]
+    core = core & (generations(len(core), sources[inner], targets[inner]) < 0)
+    inner = core[sources] & core[targets]
+    return core & (generations(len(core), targets[inner], sources[inner]) < 0)
+
+def strongly_connected(sources: List[int], targets: List[int]) -> List[List[int]]:
+    # Iterative Tarjan; returns the components with more than one node.
+    adjacent: Dict[int, List[int]] = {}
+    for source, target in zip(sources, targets):
+        adjacent.setdefault(source, []).append(target)
+    index: Dict[int, int] = {}
+    low: Dict[int, int] = {}
+    stack: List[int] = []
+    on_stack: Set[int] = set()
+    components = []
+    for root in adjacent:
+        if root in index:
+            continue
+        work = [(root, 0)]
+        while work:
+            node, i = work.pop()
+            if i == 0:
+                index[node] = low[node] = len(index)
+                stack.append(node)
+                on_stack.add(node)
+            children = adjacent.get(node, ())
+            while i < len(children):
+                child = children[i]
+                i += 1
+                if child not in index:
+                    work.append((node, i))
+                    work.append((child, 0))
+                    break
+                if child in on_stack:
+                    low[node] = min(low[node], index[child])
+            else:
+                if low[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    if len(component) > 1:
+                        components.append(component)
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+    return components
+
+# Cyclic cores larger than this have their big components peeled off by
+# forward/backward reachability in numpy before Tarjan runs in Python.
+SCC_PYTHON_MAX = 1 << 12
+
+def symbol_strata(n_symbols: int, sources: np.ndarray, targets: np.ndarray) -> np.ndarray:
+    # Stratum of every symbol in the condition -> conclusion graph given as
+    # edge arrays: cycles are collapsed and each component is numbered by
+    # its topological generation, like networkx's condensation would.
+    sources = np.asarray(sources, dtype=np.int64)
+    targets = np.asarray(targets, dtype=np.int64)
+    distinct = sources != targets
+    pairs = tally(sources[distinct] * n_symbols + targets[distinct])[0]
+    sources, targets = pairs // max(n_symbols, 1), pairs % max(n_symbols, 1)
+    level = generations(n_symbols, sources, targets)
+    if (level >= 0).all():
+        return level
+    component = np.arange(n_symbols)
+    core = cyclic_core(level < 0, sources, targets)
+    while np.count_nonzero(core) > SCC_PYTHON_MAX:
+        # The component of a well-connected pivot is the intersection of
+        # what it reaches and what reaches it; stop once that comes back small.
+        inner = core[sources] & core[targets]
+        forward = adjacency(n_symbols, sources[inner], targets[inner])
+        backward = adjacency(n_symbols, targets[inner], sources[inner])
+        pivot = int(np.argmax(np.diff(forward[0]) * np.diff(backward[0])))
+        members = reachable(*forward, pivot) & reachable(*backward, pivot)
+        component[members] = pivot
+        core = cyclic_core(core & ~members, sources, targets)
+        if np.count_nonzero(members) <= SCC_PYTHON_MAX:
+            break
+    inner = core[sources] & core[targets]
+    for members in strongly_connected(sources[inner].tolist(), targets[inner].tolist()):
+        component[members] = members[0]
+    sources, targets = component[sources], component[targets]
+    distinct = sources != targets
+    return generations(n_symbols, sources[distinct], targets[distinct])[component]
+
+class KnowledgeBase:
+    ENGINES = ('naive', 'indexed', 'rete')
+    # tombstoned slots tolerated before compacting, however few rules are live
+    COMPACT_MIN_DEAD = 1024
+
+    def __init__(self, engine: str = 'indexed'):
+        if engine not in self.ENGINES:
+            raise ValueError(f"Unknown engine: {engine}")
+        self.engine = engine
+        self.facts = set()
+        self.history = []
+        # Interned symbol table: indicator string <-> bit position
+        self.symbols: Dict[str, int] = {}
+        self.symbol_names: List[str] = []
+        self.rules = RuleStore(self.symbol_names)
+        # The indexes and match state below refer to rule store slots, not
+        # rule ids. Tombstoned slots stay in the indexes and are skipped
+        # until dead slots outnumber live ones and the store is compacted.
+        # symbol id -> slots of the rules that mention it
+        self.condition_index: Dict[int, array] = {}
+        # conclusion symbol id -> slots of the rules that derive it
+        self.conclusion_index: Dict[int, array] = {}
+        # Incremental match state: the facts the fired set reflects, as a
+        # bitmask, how many distinct conditions of each slot they satisfy,
+        # and the live slots whose conditions are all satisfied.
+        self.fact_mask = 0
+        self.satisfied = array('i')
+        self.fired: Set[int] = set()
+        self.rete = ReteNetwork() if engine == 'rete' else None
+        # conclusions asserted by the last forward_chain pass
+        self.derived_facts: Set[str] = set()
+        # immutable snapshot for stateless evaluation, rebuilt after add_rule
+        self.compiled: Optional[CompiledRulebase] = None
+        # symbol id -> stratum for forward_chain, rebuilt after rule changes
+        self.strata_cache: Optional[np.ndarray] = None
+        self.result_cache = ResultCache()
+        # Fact presence statistics and each rule's conditions ordered rarest
+        # first; the order is refreshed whenever the observation count doubles.
+        self.statistics = FactStatistics()
+        self.next_reorder = 64
+        # Deadlines of facts added with a ttl. The wheel may hold outdated
+        # entries for a fact; only the one matching expiries[fact] expires
+        # it, earlier ones reschedule it.
+        self.expiries: Dict[str, float] = {}
+        self.wheel: Optional[TimingWheel] = None
+        # latest event time passed to add_fact/apply_events, if any
+        self.event_time: Optional[float] = None
+        # Window predicates by the fact they count, and that fact's recent
+        # add_fact timestamps, as many as the largest at_least needs.
+        self.windows: Dict[str, List[WindowCount]] = {}
+        self.occurrences: Dict[str, RingBuffer] = {}
+        # Sequence automata by pseudo-fact name and by the facts they consume.
+        self.sequences: Dict[str, SequenceMatcher] = {}
+        self.sequence_index: Dict[str, List[SequenceMatcher]] = {}
+        
+    def add_rule(self, conditions: List, conclusion: str, confidence: float) -> int:
+        slot = self.insert_rule(conditions, conclusion, confidence)
+        return self.rules.slot_ids[slot]
+
+    def remove_rule(self, rule_id: int, graph: Optional['KnowledgeGraph'] = None) -> Dict:
+        # Returns the removed rule; its edges leave graph when one is given.
+        rule = self.rules[rule_id]
+        self.drop_slot(self.rules.remove(rule_id))
+        if graph is not None:
+            graph.remove_rule_from_graph(rule['conditions'], rule['conclusion'])
+        return rule
+
+    def update_rule(self, rule_id: int, conditions: List, conclusion: str,
+                    confidence: float, graph: Optional['KnowledgeGraph'] = None) -> Dict:
+        # The rule keeps its id; its new version goes into a fresh slot.
+        # Returns the previous version.
+        rule = self.remove_rule(rule_id, graph)
+        self.insert_rule(conditions, conclusion, confidence, rule_id)
+        if graph is not None:
+            graph.add_rule_to_graph(conditions, conclusion)
+        return rule
+
+    def insert_rule(self, conditions: List, conclusion: str, confidence: float,
+                    rule_id: Optional[int] = None) -> int:
+        conditions = list(dict.fromkeys(self.condition_names(conditions)))
+        cond_ids = [self.intern(cond) for cond in conditions]
+        order_ids = [self.symbols[cond] for cond in self.statistics.order(conditions)]
+        conclusion_id = self.intern(conclusion)
+        slot = self.rules.append(cond_ids, order_ids, conclusion_id, confidence, rule_id)
+        self.compiled = None
+        self.strata_cache = None
+        if self.result_cache.entries:
+            self.result_cache.invalidate(frozenset(cond_ids))
+        self.conclusion_index.setdefault(conclusion_id, array('i')).append(slot)
+        for symbol_id in cond_ids:
+            self.condition_index.setdefault(symbol_id, array('i')).append(slot)
+        satisfied = sum(self.fact_mask >> symbol_id & 1 for symbol_id in cond_ids)
+        self.satisfied.append(satisfied)
+        if self.rete is not None:
+            self.rete.add_rule(slot, conditions)
+        elif satisfied == len(cond_ids):
+            self.fired.add(slot)
+        return slot
+
+    def add_rules(self, rules: Iterable) -> range:
+        # Bulk add_rule for (conditions, conclusion, confidence) rows: rows
+        # are interned straight into column buffers and the store, indexes
+        # and match state are extended once at the end. Returns the new ids.
+        cond_ends = array('q')
+        cond_ids = array('i')
+        conclusion_ids = array('i')
+        confidences = array('d')
+        intern = self.intern
+        for conditions, conclusion, confidence in rules:
+            cond_ids.extend([intern(cond) for cond in dict.fromkeys(self.condition_names(conditions))])
+            cond_ends.append(len(cond_ids))
+            conclusion_ids.append(intern(conclusion))
+            confidences.append(confidence)
+        return self.add_columns(cond_ends, cond_ids, conclusion_ids, confidences)
+
+    def add_columns(self, cond_ends, cond_ids, conclusion_ids, confidences) -> range:
+        # Column form of add_rules; symbol ids must already be interned.
+        cond_ends = np.asarray(cond_ends, dtype=np.int64)
+        cond_ids = np.asarray(cond_ids, dtype=np.int32)
+        conclusion_ids = np.asarray(conclusion_ids, dtype=np.int32)
+        n = len(conclusion_ids)
+        first_id = len(self.rules.slot_of)
+        if not n:
+            return range(first_id, first_id)
+        order_ids = self.condition_order(np.concatenate(([0], cond_ends)), cond_ids)
+        first_slot = self.rules.extend(cond_ends, cond_ids, order_ids, conclusion_ids,
+                                       confidences)
+        slots = np.arange(first_slot, first_slot + n, dtype=np.int32)
+        sizes = np.diff(cond_ends, prepend=0)
+        owners = np.repeat(slots, sizes)
+        for index, keys, values in ((self.condition_index, cond_ids, owners),
+                                    (self.conclusion_index, conclusion_ids, slots)):
+            order = np.argsort(keys, kind='stable')
+            keys, values = keys[order], values[order]
+            starts = np.flatnonzero(np.diff(keys, prepend=-1))
+            for key, group in zip(keys[starts].tolist(), np.split(values, starts[1:])):
+                index.setdefault(key, array('i')).frombytes(group.tobytes())
+        known = np.zeros(len(self.symbol_names), dtype=bool)
+        known[[self.symbols[fact] for fact in self.symbols_in(self.fact_mask)]] = True
+        satisfied = np.bincount(owners - first_slot, weights=known[cond_ids],
+                                minlength=n).astype(np.int32)
+        self.satisfied.frombytes(satisfied.tobytes())
+        if self.rete is not None:
+            for slot in slots.tolist():
+                self.rete.add_rule(slot, [self.symbol_names[s] for s in self.rules.conditions(slot)])
+        else:
+            self.fired.update(slots[satisfied == sizes].tolist())
+        self.compiled = None
+        self.strata_cache = None
+        self.result_cache.clear()
+        return range(first_id, first_id + n)
+
+    def drop_slot(self, slot: int):
+        # Index entries for the slot stay behind as tombstones; only state
+        # that could make it fire again is cleared.
+        self.compiled = None
+        self.strata_cache = None
+        if self.result_cache.entries:
+            self.result_cache.invalidate(frozenset(self.rules.conditions(slot)))
+        if self.rete is not None:
+            self.rete.remove_rule(slot)
+        self.fired.discard(slot)
+        if self.rules.dead() > max(len(self.rules), self.COMPACT_MIN_DEAD):
+            self.compact()
+
+    def compact(self):
+        # Drops tombstoned slots from the store, indexes and match state.
+        # Amortized over the removals that made them outnumber live slots.
+        remap = self.rules.compact()
+        for index in (self.condition_index, self.conclusion_index):
+            for key, slots in list(index.items()):
+                slots = remap[np.frombuffer(slots, dtype=np.int32)]
+                slots = slots[slots >= 0]
+                if len(slots):
+                    index[key] = array('i', slots.astype(np.int32).tobytes())
+                else:
+                    del index[key]
+        alive = remap >= 0
+        self.satisfied = array('i', np.frombuffer(self.satisfied, dtype=np.int32)[alive].tobytes())
+        self.fired = {int(remap[slot]) for slot in self.fired}
+        if self.rete is not None:
+            # Shared beta nodes of removed rules go with the old network.
+            self.rete = ReteNetwork()
+            for fact in self.symbols_in(self.fact_mask):
+                self.rete.assert_fact(fact)
+            for slot in range(len(self.rules.slot_ids)):
+                self.rete.add_rule(slot, [self.symbol_names[s] for s in self.rules.conditions(slot)])
+
+    def intern(self, symbol: str) -> int:
+        symbol_id = self.symbols.get(symbol)
+        if symbol_id is None:
+            symbol_id = self.symbols[symbol] = len(self.symbol_names)
+            self.symbol_names.append(symbol)
+        return symbol_id
+
+    def mask_of(self, symbols) -> int:
+        # Only rules intern symbols; a fact no rule mentions has no bit, so
+        # a live stream of unrelated facts cannot grow the symbol table.
+        mask = 0
+        for symbol in symbols:
+            symbol_id = self.symbols.get(symbol)
+            if symbol_id is not None:
+                mask |= 1 << symbol_id
+        return mask
+
+    def symbols_in(self, mask: int) -> List[str]:
+        names = []
+        while mask:
+            low = mask & -mask
+            names.append(self.symbol_names[low.bit_length() - 1])
+            mask ^= low
+        return names
+        
+    def condition_names(self, conditions) -> List[str]:
+        # Plain conditions pass through; window predicates are registered
+        # and replaced by their pseudo-fact.
+        names = []
+        for condition in conditions:
+            if isinstance(condition, WindowCount):
+                windows = self.windows.setdefault(condition.fact, [])
+                if all(w.name != condition.name for w in windows):
+                    windows.append(condition)
+                self.occurrences.setdefault(condition.fact, RingBuffer(1)).grow(condition.at_least)
+                condition = condition.name
+            elif isinstance(condition, SequencePattern):
+                if condition.name not in self.sequences:
+                    matcher = self.sequences[condition.name] = SequenceMatcher(condition)
+                    for fact in matcher.steps_of:
+                        self.sequence_index.setdefault(fact, []).append(matcher)
+                condition = condition.name
+            names.append(condition)
+        return names
+
+    def add_fact(self, fact: str, ttl: Optional[float] = None, now: Optional[float] = None):
+        # With a ttl the fact expires ttl seconds after now unless re-added.
+        # now is the fact's event time; once facts carry one the KB runs on
+        # event time, otherwise on time.monotonic() (see clock()). Expired
+        # facts are retracted before rules are evaluated. Each call also
+        # counts as an occurrence for window predicates on the fact and as
+        # an event for sequence automata.
+        if now is not None:
+            self.event_time = now
+        self.insert_fact(fact, ttl, now)
+
+    def insert_fact(self, fact: str, ttl: Optional[float], now: Optional[float]):
+        # add_fact without touching the clock, also used for the pseudo-facts
+        # of window predicates and sequences.
+        occurrences = self.occurrences.get(fact)
+        matchers = self.sequence_index.get(fact)
+        if now is None and (ttl is not None or occurrences is not None or matchers is not None):
+            now = self.clock()
+        if ttl is None:
+            self.expiries.pop(fact, None)
+        else:
+            if self.wheel is None:
+                self.wheel = TimingWheel(now)
+            deadline = now + ttl
+            current = self.expiries.get(fact)
+            self.expiries[fact] = deadline
+            # A pending entry for an earlier deadline re-arms itself when it
+            # comes due, so extending a deadline needs no new entry.
+            if current is None or deadline < current:
+                self.wheel.schedule(deadline, (fact, deadline))
+        self.facts.add(fact)
+        self.assert_match(fact)
+        self.history.append(f"Added indicator: {fact}")
+        if occurrences is not None:
+            occurrences.push(now)
+            for window in self.windows[fact]:
+                # holds until the at_least-th latest occurrence leaves the window
+                start = occurrences.recent(window.at_least)
+                if start >= now - window.within:
+                    self.insert_fact(window.name, start + window.within - now, now)
+        if matchers is not None:
+            for matcher in matchers:
+                if matcher.advance(fact, now):
+                    self.insert_fact(matcher.sequence.name, matcher.sequence.hold, now)
+
+    def retract_fact(self, fact: str):
+        self.expiries.pop(fact, None)
+        if fact not in self.facts:
+            return
+        self.facts.discard(fact)
+        self.retract_match(fact)
+        self.history.append(f"Retracted indicator: {fact}")
+
+    def clear_facts(self):
+        self.facts.clear()
+        self.expiries.clear()
+        self.wheel = None
+        for fact, occurrences in self.occurrences.items():
+            self.occurrences[fact] = RingBuffer(len(occurrences.times))
+        for matcher in self.sequences.values():
+            matcher.reset()
+        for fact in self.symbols_in(self.fact_mask):
+            self.retract_match(fact)
+
+    def apply_events(self, events: Iterable[tuple]):
+        # Consumes a timestamped fact stream of (timestamp, fact, asserted)
+        # changes in time order; timestamps also drive expiry.
+        for timestamp, fact, asserted in events:
+            self.event_time = timestamp
+            self.expire_facts(timestamp)
+            if asserted:
+                self.add_fact(fact, now=timestamp)
+            else:
+                self.retract_fact(fact)
+
+    def clock(self) -> float:
+        # Event time of the latest timestamped fact, else time.monotonic().
+        return time.monotonic() if self.event_time is None else self.event_time
+
+    def expire_facts(self, now: Optional[float] = None) -> List[str]:
+        # Retracts the facts whose ttl ran out by now (default: clock());
+        # rules that depended on them leave the fired set through the usual
+        # incremental retraction.
+        if self.wheel is None:
+            return []
+        if now is None:
+            now = self.clock()
+        expired = []
+        for fact, deadline in self.wheel.advance(now):
+            current = self.expiries.get(fact)
+            if current is None or current < deadline:
+                continue
+            if current > deadline and current > now:
+                self.wheel.schedule(current, (fact, current))
+                continue
+            del self.expiries[fact]
+            if fact in self.facts:
+                self.facts.discard(fact)
+                self.retract_match(fact)
+                self.history.append(f"Expired indicator: {fact}")
+                expired.append(fact)
+        return expired
+
+    def assert_match(self, fact: str):
+        # Only rules that mention the fact change state; a rule fires when
+        # this fact fills its last missing condition. A fact without a symbol
+        # is picked up by sync_facts once a rule mentions it.
+        symbol_id = self.symbols.get(fact)
+        if symbol_id is None:
+            return
+        bit = 1 << symbol_id
+        if self.fact_mask & bit:
+            return
+        self.fact_mask |= bit
+        if self.rete is not None:
+            self.rete.assert_fact(fact)
+            return
+        satisfied = self.satisfied
+        for slot in self.condition_index.get(symbol_id, ()):
+            satisfied[slot] += 1
+            if satisfied[slot] == self.rules.size(slot) and self.rules.alive(slot):
+                self.fired.add(slot)
+
+    def retract_match(self, fact: str):
+        symbol_id = self.symbols.get(fact)
+        if symbol_id is None:
+            return
+        bit = 1 << symbol_id
+        if not self.fact_mask & bit:
+            return
+        self.fact_mask ^= bit
+        if self.rete is not None:
+            self.rete.retract_fact(fact)
+            return
+        satisfied = self.satisfied
+        for slot in self.condition_index.get(symbol_id, ()):
+            satisfied[slot] -= 1
+            self.fired.discard(slot)
+
+    def sync_facts(self):
+        # Catch up with callers that edit self.facts directly.
+        mask = self.mask_of(self.facts)
+        if mask == self.fact_mask:
+            return
+        for fact in self.symbols_in(self.fact_mask & ~mask):
+            self.retract_match(fact)
+        for fact in self.symbols_in(mask & ~self.fact_mask):
+            self.assert_match(fact)
+        
+    def evaluate_rules(self) -> List[Dict]:
+        self.expire_facts()
+        self.statistics.observe(self.facts)
+        if self.statistics.observations >= self.next_reorder:
+            self.reorder_conditions()
+        if self.engine == 'naive':
+            names = self.symbol_names
+            fired = [slot for slot in self.rules.live_slots()
+                     if all(names[s] in self.facts for s in self.rules.ordered_conditions(slot))]
+        else:
+            self.sync_facts()
+            fired = sorted(self.rete.fired if self.rete is not None else self.fired,
+                           key=self.rules.slot_ids.__getitem__)
+        return [self.rules.result(slot) for slot in fired]
+
+    def condition_order(self, cond_ptr: np.ndarray, cond_ids: np.ndarray) -> np.ndarray:
+        # Sort every rule's condition slice by (fact count, symbol id) in one
+        # vectorized pass over CSR arrays.
+        counts = np.array([self.statistics.counts.get(name, 0) for name in self.symbol_names],
+                          dtype=np.int64)
+        owners = np.repeat(np.arange(len(cond_ptr) - 1), np.diff(cond_ptr))
+        order = np.lexsort((cond_ids, counts[cond_ids], owners))
+        return cond_ids[order].astype(np.int32)
+
+    def reorder_conditions(self):
+        order_ids = self.condition_order(np.array(self.rules.cond_ptr, dtype=np.int64),
+                                         np.array(self.rules.cond_ids, dtype=np.int64))
+        self.rules.order_ids = array('i', order_ids.tobytes())
+        self.next_reorder = 2 * max(self.statistics.observations, 32)
+
+    def save_statistics(self, path: str):
+        self.statistics.save(path)
+
+    def load_statistics(self, path: str):
+        self.statistics = FactStatistics.load(path)
+        self.reorder_conditions()
+
+    def compile(self) -> 'CompiledRulebase':
+        if self.compiled is None:
+            self.compiled = CompiledRulebase(self)
+        return self.compiled
+
+    def digest(self) -> bytes:
+        # Fingerprint of everything a CompiledRulebase is built from: the
+        # live rules in rule id order and the names of the symbols they use.
+        rules = self.rules
+        slot_of = np.array(rules.slot_of, dtype=np.int64)
+        rule_ids = np.flatnonzero(slot_of >= 0)
+        slots = slot_of[rule_ids]
+        cond_ptr = np.array(rules.cond_ptr, dtype=np.int64)
+        sizes = cond_ptr[slots + 1] - cond_ptr[slots]
+        offsets = np.repeat(cond_ptr[slots] - np.cumsum(sizes) + sizes, sizes) + np.arange(sizes.sum())
+        cond_ids = np.array(rules.cond_ids, dtype=np.int32)[offsets]
+        conclusion_ids = np.array(rules.conclusion_ids, dtype=np.int32)[slots]
+        symbol_ids = np.union1d(cond_ids, conclusion_ids)
+        h = hashlib.sha256(struct.pack('<IIIQQ', CompiledRulebase.FILE_VERSION,
+                                       CompiledRulebase.LOOKUP_MAX_SYMBOLS,
+                                       CompiledRulebase.LOOKUP_MAX_RESULTS,
+                                       CompiledRulebase.LOOKUP_MAX_POSITIONS,
+                                       CompiledRulebase.LOOKUP_MAX_WORK))
+        for column in (rule_ids, sizes, cond_ids, conclusion_ids,
+                       np.array(rules.confidences, dtype=np.float64)[slots], symbol_ids):
+            h.update(struct.pack('<Q', len(column)))
+            h.update(column.tobytes())
+        h.update('\0'.join(self.symbol_names[s] for s in symbol_ids.tolist()).encode())
+        return h.digest()
+
+    def compile_file(self, path: str) -> CompiledRulebase:
+        # Opens the compiled rulebase at path, rewriting it first when it is
+        # missing, truncated, corrupted, from another format version or
+        # stale. The file is always checksummed here, since a flipped byte
+        # in an array section would otherwise be served as data.
+        digest = self.digest()
+        try:
+            return CompiledRulebase.load(path, digest, verify=True)
+        except (OSError, ValueError):
+            self.compile().save(path, digest)
+            return CompiledRulebase.load(path, digest, verify=True)
+
+    def evaluate_batch(self, fact_sets, chunk_size: int = 4096) -> List[List[Dict]]:
+        return self.compile().diagnose_batch(fact_sets, chunk_size)
+
+    def strata(self) -> np.ndarray:
+        # Stratum of every symbol id in the condition -> conclusion graph of
+        # the live rules, built from the rule store's columns.
+        if self.strata_cache is None:
+            store = self.rules
+            sizes = np.diff(np.array(store.cond_ptr, dtype=np.int64))
+            owners = np.repeat(np.arange(len(sizes)), sizes)
+            alive = np.array(store.slot_ids, dtype=np.int64)[owners] >= 0
+            sources = np.array(store.cond_ids, dtype=np.int64)[alive]
+            targets = np.array(store.conclusion_ids, dtype=np.int64)[owners[alive]]
+            self.strata_cache = symbol_strata(len(self.symbol_names), sources, targets)
+        return self.strata_cache
+
+    def forward_chain(self, graph: Optional['KnowledgeGraph'] = None) -> List[Dict]:
+        # Feed conclusions back in as derived facts until nothing new fires.
+        # With a graph, the agenda is drained stratum by stratum following
+        # the rules' condition -> conclusion topology (see strata()), and a
+        # rule fires at most once, which also breaks cycles.
+        strata = self.strata() if graph is not None else None
+        known = {self.symbols[fact] for fact in self.facts if fact in self.symbols}
+        visited = set()
+        agenda = []
+        for c in self.evaluate_rules():
+            slot = self.rules.slot(c['rule_id'])
+            visited.add(slot)
+            stratum = strata[self.rules.conclusion_ids[slot]] if strata is not None else 0
+            agenda.append((stratum, c['rule_id'], slot))
+        heapq.heapify(agenda)
+        conclusions = []
+        while agenda:
+            _, _, slot = heapq.heappop(agenda)
+            conclusions.append(self.rules.result(slot))
+            symbol_id = self.rules.conclusion_ids[slot]
+            if symbol_id in known:
+                continue
+            known.add(symbol_id)
+            for dependent in self.condition_index.get(symbol_id, ()):
+                if dependent in visited or not self.rules.alive(dependent):
+                    continue
+                if all(s in known for s in self.rules.conditions(dependent)):
+                    visited.add(dependent)
+                    conclusion = self.rules.conclusion_ids[dependent]
+                    stratum = strata[conclusion] if strata is not None else 0
+                    heapq.heappush(agenda, (stratum, self.rules.slot_ids[dependent], dependent))
+        self.derived_facts = {self.symbol_names[s] for s in known} - self.facts
+        return conclusions
+
+    def analyze(self, graph: Optional['KnowledgeGraph'] = None) -> List[Dict]:
+        # Forward-chained conclusions sorted by confidence, memoized on the
+        # asserted symbols since the same indicator combinations keep recurring.
+        self.expire_facts()
+        symbols = self.symbols
+        key = frozenset(symbols[fact] for fact in self.facts if fact in symbols)
+        entry = self.result_cache.get(key)
+        if entry is None:
+            conclusions = self.forward_chain(graph)
+            conclusions.sort(key=lambda x: x['confidence'], reverse=True)
+            known = key.union(symbols[fact] for fact in self.derived_facts)
+            self.result_cache.put(key, known, conclusions)
+        else:
+            known, conclusions = entry
+            self.derived_facts = {self.symbol_names[s] for s in known - key}
+        return [dict(c) for c in conclusions]
+
+    def prove(self, goal: str, graph: Optional['KnowledgeGraph'] = None) -> Optional[Dict]:
+        # Backward chaining: the rules that can contribute to the goal are
+        # collected once through conclusion_index, then derivability is
+        # propagated over just those rules with per-rule counters of unmet
+        # conditions, so cycles cost nothing extra. Returns the first live
+        # rule concluding the goal whose conditions all hold or derive. A
+        # symbol no live rule concludes can only be a plain fact, which the
+        # index already tells, so graph is not needed for that shortcut.
+        self.expire_facts()
+        if goal in self.facts:
+            return {'conclusion': goal, 'confidence': 1.0, 'rule_id': None}
+        rules = self.rules
+
+        def deriving(symbol_id: int) -> List[int]:
+            return [slot for slot in self.conclusion_index.get(symbol_id, ()) if rules.alive(slot)]
+
+        goal_id = self.symbols.get(goal)
+        candidates = deriving(goal_id) if goal_id is not None else []
+        if not candidates:
+            return None
+        facts = {self.symbols[fact] for fact in self.facts if fact in self.symbols}
+        # slot -> conditions neither asserted nor derived yet, and symbol id
+        # -> cone slots waiting on it
+        missing: Dict[int, int] = {}
+        waiting: Dict[int, List[int]] = {}
+        ready = []
+        seen = {goal_id}
+        stack = [goal_id]
+        while stack:
+            for slot in deriving(stack.pop()):
+                conditions = set(rules.conditions(slot)) - facts
+                missing[slot] = len(conditions)
+                if not conditions:
+                    ready.append(slot)
+                for symbol_id in conditions:
+                    waiting.setdefault(symbol_id, []).append(slot)
+                    if symbol_id not in seen:
+                        seen.add(symbol_id)
+                        stack.append(symbol_id)
+        derived = set()
+        while ready:
+            symbol_id = rules.conclusion_ids[ready.pop()]
+            if symbol_id in derived:
+                continue
+            derived.add(symbol_id)
+            for slot in waiting.get(symbol_id, ()):
+                missing[slot] -= 1
+                if not missing[slot]:
+                    ready.append(slot)
+        for slot in candidates:
+            if not missing[slot]:
+                return rules.result(slot)
+        return None
+
+class DiagnosisSession:
+    # Per-machine state on top of a shared CompiledRulebase: facts, history
+    # and the incrementally maintained fired set. The rulebase is only read,
+    # so one instance in memory can back any number of sessions on any
+    # threads. Match state is sparse, holding only the rules that mention
+    # an asserted fact, so a session costs memory in proportion to its facts
+    # rather than to the rulebase.
+    def __init__(self, rulebase: CompiledRulebase):
+        self.rulebase = rulebase
+        self.facts = set()
+        self.history = []
+        self.derived_facts: Set[str] = set()
+        # rule position -> distinct conditions satisfied by the facts
+        self.satisfied: Dict[int, int] = {}
+        self.fired: Set[int] = set(
+            rulebase.indices[rulebase.indptr[rulebase.n_symbols]:].tolist())
+
+    def add_fact(self, fact: str):
+        if fact not in self.facts:
+            self.facts.add(fact)
+            self.match(fact, 1)
+        self.history.append(f"Added indicator: {fact}")
+
+    def retract_fact(self, fact: str):
+        if fact not in self.facts:
+            return
+        self.facts.discard(fact)
+        self.match(fact, -1)
+        self.history.append(f"Retracted indicator: {fact}")
+
+    def clear_facts(self):
+        for fact in list(self.facts):
+            self.retract_fact(fact)
+
+    def match(self, fact: str, delta: int):
+        rb = self.rulebase
+        symbol_id = rb.symbols.get(fact)
+        if symbol_id is None:
+            return
+        satisfied = self.satisfied
+        for pos in rb.indices[rb.indptr[symbol_id]:rb.indptr[symbol_id + 1]].tolist():
+            count = satisfied.get(pos, 0) + delta
+            if count:
+                satisfied[pos] = count
+            else:
+                del satisfied[pos]
+            if count == rb.needed[pos]:
+                self.fired.add(pos)
+            else:
+                self.fired.discard(pos)
+
+    def evaluate_rules(self) -> List[Dict]:
+        return self.rulebase.results(sorted(self.fired))
+
+    def forward_chain(self, graph: Optional['KnowledgeGraph'] = None) -> List[Dict]:
+        # Same agenda order as KnowledgeBase.forward_chain; the session's
+        # match counts are copied, so chaining leaves the session unchanged.
+        rb = self.rulebase
+        names = rb.symbol_names
+        strata = rb.strata() if graph is not None else None
+        symbols = rb.symbols
+        known = {symbols[fact] for fact in self.facts if fact in symbols}
+        counts = dict(self.satisfied)
+        agenda = [(strata[rb.conclusion_ids[pos]] if strata is not None else 0, pos)
+                  for pos in self.fired]
+        heapq.heapify(agenda)
+        order = []
+        while agenda:
+            _, pos = heapq.heappop(agenda)
+            order.append(pos)
+            symbol_id = int(rb.conclusion_ids[pos])
+            if symbol_id in known:
+                continue
+            known.add(symbol_id)
+            for dependent in rb.indices[rb.indptr[symbol_id]:rb.indptr[symbol_id + 1]].tolist():
+                counts[dependent] = counts.get(dependent, 0) + 1
+                if counts[dependent] == rb.needed[dependent]:
+                    stratum = strata[rb.conclusion_ids[dependent]] if strata is not None else 0
+                    heapq.heappush(agenda, (stratum, dependent))
+        self.derived_facts = {names[s] for s in known} - self.facts
+        return rb.results(order)
+
+    def analyze(self, graph: Optional['KnowledgeGraph'] = None) -> List[Dict]:
+        conclusions = self.forward_chain(graph)
+        conclusions.sort(key=lambda x: x['confidence'], reverse=True)
+        return conclusions
+
+# Rulebase installed once per worker process by ParallelBatchRunner.
+WORKER_RULEBASE: Optional[CompiledRulebase] = None
+
+def init_worker(rulebase):
+    # A path is opened with mmap so all workers share the page-cached file;
+    # ParallelBatchRunner has verified it already, so it is not re-read.
+    global WORKER_RULEBASE
+    if isinstance(rulebase, str):
+        rulebase = CompiledRulebase.load(rulebase)
+    WORKER_RULEBASE = rulebase
+
+def diagnose_chunk(fact_sets: List) -> tuple:
+    # Only the compact (row_ptr, positions) arrays travel back to the parent.
+    # match_chunks may split the chunk to respect BATCH_MAX_PAIRS, so the
+    # sub-chunks are stitched back together.
+    start = time.perf_counter()
+    row_ptrs = [np.zeros(1, dtype=np.int64)]
+    chunk_positions = [np.zeros(0, dtype=np.int64)]
+    offset = 0
+    for row_ptr, positions in WORKER_RULEBASE.match_chunks(fact_sets, len(fact_sets)):
+        row_ptrs.append(row_ptr[1:] + offset)
+        chunk_positions.append(positions)
+        offset += len(positions)
+    row_ptr = np.concatenate(row_ptrs)
+    assert len(row_ptr) - 1 == len(fact_sets)
+    return row_ptr, np.concatenate(chunk_positions), os.getpid(), time.perf_counter() - start
+
+class ParallelBatchRunner:
+    # Shards a stream of fact sets over worker processes. The compiled
+    # rulebase is pickled once per worker through the pool initializer, or
+    # mapped from disk when given as the path of a compiled rulebase file;
+    # chunks are submitted with a bounded number in flight, and results
+    # are yielded back in input order.
+    def __init__(self, rulebase, workers: Optional[int] = None, chunk_size: int = 20000):
+        self.source = rulebase
+        if isinstance(rulebase, str):
+            rulebase = CompiledRulebase.load(rulebase, verify=True)
+        self.rulebase = rulebase
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        # worker pid -> {'fact_sets': ..., 'seconds': ...}
+        self.stats: Dict[int, Dict[str, float]] = {}
+
+    def run(self, fact_sets) -> Iterator[List[Dict]]:
+        fact_sets = iter(fact_sets)
+        with ProcessPoolExecutor(self.workers, initializer=init_worker,
+                                 initargs=(self.source,)) as pool:
+            pending = []
+            while True:
+                while len(pending) < 2 * self.workers:
+                    chunk = list(islice(fact_sets, self.chunk_size))
+                    if not chunk:
+                        break
+                    pending.append(pool.submit(diagnose_chunk, chunk))
+                if not pending:
+                    break
+                row_ptr, positions, pid, seconds = pending.pop(0).result()
+                worker = self.stats.setdefault(pid, {'fact_sets': 0, 'seconds': 0.0})
+                worker['fact_sets'] += len(row_ptr) - 1
+                worker['seconds'] += seconds
+                yield from self.rulebase.expand(row_ptr, positions)
+
+    def throughput(self) -> Dict[int, float]:
+        # fact sets per second of busy time, per worker pid
+        return {pid: worker['fact_sets'] / worker['seconds'] if worker['seconds'] else 0.0
+                for pid, worker in self.stats.items()}
+
+class KnowledgeGraph:
+    # Edges are kept as (condition, conclusion) -> number of supporting
+    # rules; the networkx graph is built from them on first use, so networkx
+    # is only imported by graph queries and plotting. Edges bulk-added from
+    # a KnowledgeBase stay as symbol id pairs until something reads them.
+    def __init__(self):
+        self.edge_counts: Dict[tuple, int] = {}
+        # (symbol names, n_symbols, condition * n_symbols + conclusion pairs,
+        # support counts) per add_rules_from call not yet merged
+        self.pending: List[tuple] = []
+        self.graph_cache = None
+        self.strata_cache: Optional[Dict[str, int]] = None
+
+    @property
+    def edges(self) -> Dict[tuple, int]:
+        if self.pending:
+            pending, self.pending = self.pending, []
+            for symbol_names, n_symbols, pairs, counts in pending:
+                names = np.array(symbol_names[:n_symbols], dtype=object)
+                edges = zip(names[pairs // n_symbols].tolist(), names[pairs % n_symbols].tolist())
+                if self.edge_counts:
+                    for edge, count in zip(edges, counts.tolist()):
+                        self.edge_counts[edge] = self.edge_counts.get(edge, 0) + count
+                else:
+                    self.edge_counts = dict(zip(edges, counts.tolist()))
+        return self.edge_counts
+
+    @property
+    def graph(self):
+        if self.graph_cache is None:
+            import networkx as nx
+            self.graph_cache = nx.DiGraph()
+            self.graph_cache.add_edges_from((condition, conclusion, {'rules': count})
+                                            for (condition, conclusion), count
+                                            in self.edges.items())
+        return self.graph_cache
+
+    def changed(self):
+        self.graph_cache = None
+        self.strata_cache = None
+        
+    def add_rule_to_graph(self, conditions: List, conclusion: str):
+        # Edges count the rules that support them so removals stay exact.
+        for condition in dict.fromkeys(map(condition_name, conditions)):
+            edge = (condition, conclusion)
+            self.edges[edge] = self.edges.get(edge, 0) + 1
+        self.changed()
+
+    def add_rules_from(self, kb: 'KnowledgeBase', first_slot: int = 0):
+        # Bulk add_rule_to_graph for the live rules of kb from first_slot on:
+        # edge support counts are aggregated over the columns and kept in
+        # that form until edges is read.
+        rules = kb.rules
+        cond_ptr = np.array(rules.cond_ptr, dtype=np.int64)[first_slot:]
+        owners = np.repeat(np.arange(first_slot, len(cond_ptr) + first_slot - 1),
+                           np.diff(cond_ptr))
+        cond_ids = np.array(rules.cond_ids, dtype=np.int64)[cond_ptr[0]:]
+        alive = np.array(rules.slot_ids, dtype=np.int64)[owners] >= 0
+        n_symbols = len(kb.symbol_names)
+        conclusion_ids = np.array(rules.conclusion_ids, dtype=np.int64)
+        pairs = cond_ids[alive] * n_symbols + conclusion_ids[owners[alive]]
+        pairs, counts = np.unique(pairs, return_counts=True)
+        self.pending.append((kb.symbol_names, n_symbols, pairs, counts.astype(np.int32)))
+        self.changed()
+
+    def remove_rule_from_graph(self, conditions: List, conclusion: str):
+        for condition in dict.fromkeys(map(condition_name, conditions)):
+            edge = (condition, conclusion)
+            self.edges[edge] -= 1
+            if not self.edges[edge]:
+                del self.edges[edge]
+        self.changed()
+
+    def strata(self) -> Dict[str, int]:
+        # Collapse cycles, then number each node by its topological generation.
+        if self.strata_cache is None:
+            import networkx as nx
+            condensed = nx.condensation(self.graph)
+            self.strata_cache = {}
+            for level, generation in enumerate(nx.topological_generations(condensed)):
+                for component in generation:
+                    for node in condensed.nodes[component]['members']:
+                        self.strata_cache[node] = level
+        return self.strata_cache
+            
+    def plot(self, canvas):
+        import networkx as nx
+        canvas.figure.clear()
+        pos = nx.spring_layout(self.graph)
+        nx.draw(self.graph, pos, with_labels=True, node_color='lightgreen', 
+                node_size=2000, font_size=8, arrows=True,
+                edge_color='gray', ax=canvas.figure.add_subplot(111))
+        canvas.draw()
+
+def json_rule(index: int, rule) -> tuple:
+    # (conditions, conclusion, confidence) of one decoded JSON rule; a
+    # malformed rule raises ValueError naming its index in the pack.
+    if not isinstance(rule, dict):
+        raise ValueError(f"rule {index}: expected an object")
+    conditions, conclusion, confidence = (
+        rule.get(field) for field in ('conditions', 'conclusion', 'confidence'))
+    if not isinstance(conditions, list) or not all(isinstance(cond, str) for cond in conditions):
+        raise ValueError(f"rule {index}: \"conditions\" must be a list of strings")
+    if not isinstance(conclusion, str) or not conclusion:
+        raise ValueError(f"rule {index}: \"conclusion\" must be a non-empty string")
+    if isinstance(confidence, bool) or not isinstance(confidence, (int, float)):
+        raise ValueError(f"rule {index}: \"confidence\" must be a number")
+    return conditions, conclusion, float(confidence)
+
+def iter_json_rules(path: str, chunk_size: int = 1 << 20) -> Iterator[tuple]:
+    # A JSON rule pack is a list of {"conditions", "conclusion", "confidence"}
+    # objects, optionally wrapped as {"rules": [...]}. Rules are decoded one
+    # at a time from a sliding buffer, so the list is never materialized.
+    decoder = json.JSONDecoder()
+    with open(path, encoding='utf-8') as f:
+        buf = ''
+        pos = 0
+
+        def fill() -> bool:
+            nonlocal buf, pos
+            data = f.read(chunk_size)
+            buf = buf[pos:] + data
+            pos = 0
+            return bool(data)
+
+        def peek() -> str:
+            # next non-whitespace character, '' at end of file
+            nonlocal pos
+            while True:
+                while pos < len(buf) and buf[pos] in ' \t\r\n':
+                    pos += 1
+                if pos < len(buf) or not fill():
+                    return buf[pos:pos + 1]
+
+        def decode():
+            nonlocal pos
+            peek()
+            while True:
+                try:
+                    value, pos = decoder.raw_decode(buf, pos)
+                    return value
+                except json.JSONDecodeError:
+                    # possibly cut off at the end of the buffer
+                    if not fill():
+                        raise
+
+        if peek() == '{':
+            pos += 1
+            if peek() != '"' or decode() != 'rules' or peek() != ':':
+                raise ValueError("expected a leading \"rules\" key")
+            pos += 1
+        if peek() != '[':
+            raise ValueError("expected a list of rules")
+        pos += 1
+        if peek() == ']':
+            return
+        index = 0
+        while True:
+            yield json_rule(index, decode())
+            index += 1
+            separator = peek()
+            pos += 1
+            if separator == ']':
+                return
+            if separator != ',':
+                raise ValueError("expected ',' or ']' between rules")
+
+def iter_csv_rules(path: str) -> Iterator[tuple]:
+    # CSV rule pack with a conditions,conclusion,confidence header;
+    # conditions are separated by ';' and an empty cell means none. Short
+    # rows, empty conclusions or confidences and malformed CSV raise
+    # ValueError.
+    with open(path, newline='', encoding='utf-8') as f:
+        reader = csv.DictReader(f)
+        try:
+            for row in reader:
+                conditions, conclusion, confidence = (
+                    row.get(field) for field in ('conditions', 'conclusion', 'confidence'))
+                if conditions is None or not (conclusion or '').strip() \
+                        or not (confidence or '').strip():
+                    raise ValueError(f"line {reader.line_num}: expected conditions, "
+                                     "conclusion and confidence")
+                conditions = [cond.strip() for cond in conditions.split(';')]
+                yield ([cond for cond in conditions if cond], conclusion.strip(),
+                       float(confidence))
+        except csv.Error as e:
+            raise ValueError(f"line {reader.line_num}: {e}") from e
+
+def iter_rule_pack(path: str) -> Iterator[tuple]:
+    if path.lower().endswith('.csv'):
+        return iter_csv_rules(path)
+    return iter_json_rules(path)
+
+def rule_pack_cache_path(path: str, cache_dir: str) -> str:
+    h = hashlib.sha256(f"{PACK_CACHE_VERSION}:{os.path.splitext(path)[1].lower()}:".encode())
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return os.path.join(cache_dir, f"pack-{h.hexdigest()}.bin")
+
+def load_rule_pack(path: str, engine: str = 'indexed',
+                   cache_dir: Optional[str] = RULE_CACHE_DIR) -> tuple:
+    # Parsed packs are cached as raw columns keyed by the file's hash, so an
+    # unchanged pack loads without parsing on the next start.
+    kb = KnowledgeBase(engine)
+    kg = KnowledgeGraph()
+    cache_path = rule_pack_cache_path(path, cache_dir) if cache_dir is not None else None
+    cached = None
+    if cache_path is not None and os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'rb') as f:
+                cached = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            cached = None
+    if cached is not None:
+        touch_cache(cache_path)
+        names, cond_ptr, cond_ids, conclusion_ids, confidences = cached
+        for name in names:
+            kb.intern(name)
+        kb.add_columns(np.frombuffer(cond_ptr, dtype=np.int64)[1:],
+                       np.frombuffer(cond_ids, dtype=np.int32),
+                       np.frombuffer(conclusion_ids, dtype=np.int32),
+                       np.frombuffer(confidences, dtype=np.float64))
+    else:
+        kb.add_rules(iter_rule_pack(path))
+        if cache_path is not None:
+            rules = kb.rules
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+                with open(tmp_path, 'wb') as f:
+                    marshal.dump((list(kb.symbol_names), rules.cond_ptr.tobytes(),
+                                  rules.cond_ids.tobytes(), rules.conclusion_ids.tobytes(),
+                                  rules.confidences.tobytes()), f)
+                os.replace(tmp_path, cache_path)
+                prune_cache(cache_dir, 'pack-')
+            except OSError:
+                pass
+    kg.add_rules_from(kb)
+    return kb, kg
+
+class SQLiteRuleStore:
+    # Rules kept in a SQLite database instead of memory. rule_conditions is
+    # the condition index: one (symbol, rule) row per condition, clustered by
+    # symbol, with UNCONDITIONAL standing in for rules without conditions.
+    # The rules mentioning a symbol form its partition; recently used
+    # partitions are held in an LRU, everything else stays on disk.
+    UNCONDITIONAL = -1
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS symbols (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE);
+        CREATE TABLE IF NOT EXISTS rules (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conditions BLOB NOT NULL,
+            conclusion INTEGER NOT NULL,
+            confidence REAL NOT NULL);
+        CREATE TABLE IF NOT EXISTS rule_conditions (
+            symbol INTEGER NOT NULL,
+            rule INTEGER NOT NULL,
+            PRIMARY KEY (symbol, rule)) WITHOUT ROWID;
+    """
+
+    def __init__(self, path: str, max_partitions: int = 256):
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(self.SCHEMA)
+        self.symbols: Dict[str, int] = {}
+        self.symbol_names: List[str] = []
+        for symbol_id, name in self.connection.execute(
+                "SELECT id, name FROM symbols ORDER BY id"):
+            # symbol_names is indexed by id, and intern() hands out the next
+            # id as len(symbol_names)
+            if symbol_id != len(self.symbol_names):
+                self.connection.close()
+                raise ValueError(f"{path}: symbol ids are not contiguous at {symbol_id}")
+            self.symbols[name] = symbol_id
+            self.symbol_names.append(name)
+        self.max_partitions = max_partitions
+        # symbol id -> ((rule id, condition ids, conclusion id, confidence), ...)
+        self.partitions: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def close(self):
+        self.connection.close()
+
+    def intern(self, symbol: str) -> int:
+        symbol_id = self.symbols.get(symbol)
+        if symbol_id is None:
+            symbol_id = self.symbols[symbol] = len(self.symbol_names)
+            self.symbol_names.append(symbol)
+            self.connection.execute("INSERT INTO symbols (id, name) VALUES (?, ?)",
+                                    (symbol_id, symbol))
+        return symbol_id
+
+    def add_rules(self, rules: Iterable, batch_size: int = 10000) -> List[int]:
+        # One transaction for the whole stream of (conditions, conclusion,
+        # confidence) rows, inserted batch_size rules at a time. Ids are
+        # assigned here, continuing the AUTOINCREMENT sequence.
+        row = self.connection.execute(
+            "SELECT seq FROM sqlite_sequence WHERE name = 'rules'").fetchone()
+        next_id = row[0] + 1 if row else 1
+        rule_ids = []
+        touched = set()
+        rows = iter(rules)
+        # Symbols interned by a batch that rolls back must leave the
+        # in-memory table too, or their ids would be reused by the next
+        # intern() while the cache still maps the old names to them.
+        n_symbols = len(self.symbol_names)
+        try:
+            with self.connection:
+                while True:
+                    rule_rows = []
+                    condition_rows = []
+                    for conditions, conclusion, confidence in islice(rows, batch_size):
+                        # a bare string would otherwise be interned letter by letter
+                        if isinstance(conditions, str) or not isinstance(conclusion, str) \
+                                or not all(isinstance(cond, str) for cond in conditions):
+                            raise ValueError(f"rule {len(rule_ids)}: expected a list of string "
+                                             "conditions and a string conclusion")
+                        cond_ids = [self.intern(cond) for cond in dict.fromkeys(conditions)]
+                        rule_rows.append((next_id, array('i', cond_ids).tobytes(),
+                                          self.intern(conclusion), float(confidence)))
+                        keys = cond_ids or [self.UNCONDITIONAL]
+                        condition_rows.extend((symbol_id, next_id) for symbol_id in keys)
+                        touched.update(keys)
+                        rule_ids.append(next_id)
+                        next_id += 1
+                    if not rule_rows:
+                        break
+                    self.connection.executemany(
+                        "INSERT INTO rules (id, conditions, conclusion, confidence) "
+                        "VALUES (?, ?, ?, ?)", rule_rows)
+                    self.connection.executemany(
+                        "INSERT INTO rule_conditions (symbol, rule) VALUES (?, ?)", condition_rows)
+        except BaseException:
+            for name in self.symbol_names[n_symbols:]:
+                del self.symbols[name]
+            del self.symbol_names[n_symbols:]
+            raise
+        self.invalidate(touched)
+        return rule_ids
+
+    def remove(self, rule_id: int):
+        row = self.connection.execute(
+            "SELECT conditions FROM rules WHERE id = ?", (rule_id,)).fetchone()
+        if row is None:
+            raise KeyError(rule_id)
+        with self.connection:
+            self.connection.execute("DELETE FROM rules WHERE id = ?", (rule_id,))
+            self.connection.execute("DELETE FROM rule_conditions WHERE rule = ?", (rule_id,))
+        self.invalidate(array('i', row[0]).tolist() or [self.UNCONDITIONAL])
+
+    def invalidate(self, symbol_ids):
+        for symbol_id in symbol_ids:
+            self.partitions.pop(symbol_id, None)
+
+    def partition(self, symbol_id: int) -> tuple:
+        rules = self.partitions.get(symbol_id)
+        if rules is not None:
+            self.partitions.move_to_end(symbol_id)
+            self.hits += 1
+            return rules
+        self.misses += 1
+        rules = tuple(
+            (rule_id, array('i', conditions), conclusion, confidence)
+            for rule_id, conditions, conclusion, confidence in self.connection.execute(
+                "SELECT r.id, r.conditions, r.conclusion, r.confidence "
+                "FROM rule_conditions c JOIN rules r ON r.id = c.rule "
+                "WHERE c.symbol = ? ORDER BY r.id", (symbol_id,)))
+        self.partitions[symbol_id] = rules
+        while len(self.partitions) > self.max_partitions:
+            self.partitions.popitem(last=False)
+            self.evictions += 1
+        return rules
+
+    def __getitem__(self, rule_id: int) -> Dict:
+        row = self.connection.execute(
+            "SELECT conditions, conclusion, confidence FROM rules WHERE id = ?",
+            (rule_id,)).fetchone()
+        if row is None:
+            raise KeyError(rule_id)
+        conditions, conclusion, confidence = row
+        return {
+            'conditions': [self.symbol_names[s] for s in array('i', conditions)],
+            'conclusion': self.symbol_names[conclusion],
+            'confidence': confidence
+        }
+
+    def __len__(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM rules").fetchone()[0]
+
+    def stats(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'partitions': len(self.partitions)}
+
+class SQLiteKnowledgeBase:
+    # KnowledgeBase counterpart for rulebases too large to hold in memory:
+    # facts stay in memory, and evaluation only loads the partitions of the
+    # asserted facts (plus derived conclusions when chaining).
+    def __init__(self, path: str, max_partitions: int = 256):
+        self.rules = SQLiteRuleStore(path, max_partitions)
+        self.facts = set()
+        self.history = []
+        self.derived_facts: Set[str] = set()
+
+    def add_rule(self, conditions: List[str], conclusion: str, confidence: float) -> int:
+        return self.rules.add_rules([(conditions, conclusion, confidence)])[0]
+
+    def add_rules(self, rules: Iterable) -> List[int]:
+        return self.rules.add_rules(rules)
+
+    def load_rule_pack(self, path: str) -> List[int]:
+        return self.rules.add_rules(iter_rule_pack(path))
+
+    def remove_rule(self, rule_id: int):
+        self.rules.remove(rule_id)
+
+    def add_fact(self, fact: str):
+        self.facts.add(fact)
+        self.history.append(f"Added indicator: {fact}")
+
+    def retract_fact(self, fact: str):
+        if fact not in self.facts:
+            return
+        self.facts.discard(fact)
+        self.history.append(f"Retracted indicator: {fact}")
+
+    def clear_facts(self):
+        self.facts.clear()
+
+    def match(self, known: Set[int], symbol_ids, fired: Dict[int, tuple]) -> List[tuple]:
+        # Fire every rule of the given partitions whose conditions are all
+        # known and that is not in fired yet; returns the new ones by id.
+        new_rules = []
+        for symbol_id in symbol_ids:
+            for rule in self.rules.partition(symbol_id):
+                if rule[0] not in fired and all(s in known for s in rule[1]):
+                    fired[rule[0]] = rule
+                    new_rules.append(rule)
+        new_rules.sort()
+        return new_rules
+
+    def result(self, rule: tuple) -> Dict:
+        return {'conclusion': self.rules.symbol_names[rule[2]], 'confidence': rule[3],
+                'rule_id': rule[0]}
+
+    def evaluate_rules(self) -> List[Dict]:
+        symbols = self.rules.symbols
+        known = {symbols[fact] for fact in self.facts if fact in symbols}
+        fired: Dict[int, tuple] = {}
+        return [self.result(rule)
+                for rule in self.match(known, [SQLiteRuleStore.UNCONDITIONAL, *known], fired)]
+
+    def forward_chain(self) -> List[Dict]:
+        # Rounds of matching, each over only the partitions of the symbols
+        # that became known in the previous round.
+        symbols = self.rules.symbols
+        known = {symbols[fact] for fact in self.facts if fact in symbols}
+        fired: Dict[int, tuple] = {}
+        frontier = [SQLiteRuleStore.UNCONDITIONAL, *known]
+        conclusions = []
+        while frontier:
+            new_rules = self.match(known, frontier, fired)
+            frontier = []
+            for rule in new_rules:
+                conclusions.append(self.result(rule))
+                if rule[2] not in known:
+                    known.add(rule[2])
+                    frontier.append(rule[2])
+        self.derived_facts = {self.rules.symbol_names[s] for s in known} - self.facts
+        return conclusions
+
+    def analyze(self, graph: Optional['KnowledgeGraph'] = None) -> List[Dict]:
+        conclusions = self.forward_chain()
+        conclusions.sort(key=lambda x: x['confidence'], reverse=True)
+        return conclusions
+
+class RulePackWatcher:
+    # Polls a rule pack and, when it changes, parses and compiles the new
+    # rulebase on a background thread. The finished (kb, kg, stats) go to
+    # on_reload, which runs on the watcher thread and must hand them over to
+    # the consumer; the old rulebase is never touched.
+    def __init__(self, path: str, on_reload, on_error=None, interval: float = 1.0,
+                 engine: str = 'indexed'):
+        self.path = path
+        self.on_reload = on_reload
+        self.on_error = on_error
+        self.interval = interval
+        self.engine = engine
+        self.signature = self.stat()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='rule-pack-watcher', daemon=True)
+
+    def stat(self) -> Optional[tuple]:
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size, st.st_ino
+
+    def start(self) -> 'RulePackWatcher':
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            signature = self.stat()
+            if signature is not None and signature != self.signature:
+                self.signature = signature
+                self.reload()
+
+    def reload(self):
+        detected = time.perf_counter()
+        try:
+            kb, kg = load_rule_pack(self.path, self.engine)
+            parsed = time.perf_counter()
+            kb.compile()
+            kb.strata()
+        except Exception as e:
+            # A half-written or broken pack keeps the current rules; the
+            # next write changes the signature and triggers another try.
+            if self.on_error is not None:
+                self.on_error(e)
+            return
+        compiled = time.perf_counter()
+        self.on_reload(kb, kg, {'path': self.path, 'rules': len(kb.rules),
+                                'parse_ms': (parsed - detected) * 1000,
+                                'compile_ms': (compiled - parsed) * 1000,
+                                'detected': detected})
+
+class Threshold:
+    # Hysteresis band turning one sensor channel into one fact. With
+    # on >= off the fact is asserted once a reading reaches `on` and
+    # retracted once one falls to `off`; with on < off it tracks low
+    # readings instead. Without `off` there is no hysteresis.
+    def __init__(self, fact: str, channel: str, on: float, off: Optional[float] = None):
+        self.fact = fact
+        self.channel = channel
+        self.on = on
+        self.off = on if off is None else off
+        self.rising = self.on >= self.off
+
+    def states(self, values: np.ndarray, state: bool) -> np.ndarray:
+        # State after each reading, starting from `state`: the last reading
+        # outside the band decides, readings inside it (or NaN) keep it.
+        if self.rising:
+            on_hit, off_hit = values >= self.on, values <= self.off
+        else:
+            on_hit, off_hit = values <= self.on, values >= self.off
+        last = np.where(on_hit | off_hit, np.arange(len(values)), -1)
+        np.maximum.accumulate(last, out=last)
+        return np.where(last >= 0, on_hit[last], state)
+
+class SensorDiscretizer:
+    # Streaming sensor readings -> fact assertions and retractions. Input
+    # chunks are interleaved readings as (timestamps, channel ids, values)
+    # arrays, channel ids indexing self.channels. A fact fed by several
+    # thresholds holds while any of them is on.
+    def __init__(self, thresholds: List[Threshold]):
+        self.thresholds = thresholds
+        self.channels = list(dict.fromkeys(t.channel for t in thresholds))
+        self.channel_ids = {channel: i for i, channel in enumerate(self.channels)}
+        self.by_channel = [[k for k, t in enumerate(thresholds) if t.channel == channel]
+                           for channel in self.channels]
+        self.state = [False] * len(thresholds)
+        # fact -> number of its thresholds currently on
+        self.active: Dict[str, int] = {}
+
+    def transitions(self, timestamps: np.ndarray, channel_ids: np.ndarray,
+                    values: np.ndarray) -> List[tuple]:
+        # (sample index, timestamp, threshold, new state) for one chunk
+        found = []
+        for channel_id, threshold_ids in enumerate(self.by_channel):
+            samples = np.flatnonzero(channel_ids == channel_id)
+            if not len(samples):
+                continue
+            readings = values[samples]
+            for k in threshold_ids:
+                states = self.thresholds[k].states(readings, self.state[k])
+                changed = np.flatnonzero(states[1:] != states[:-1]) + 1
+                if states[0] != self.state[k]:
+                    changed = np.concatenate(([0], changed))
+                self.state[k] = bool(states[-1])
+                found.extend(zip(samples[changed].tolist(), timestamps[samples[changed]].tolist(),
+                                 [k] * len(changed), states[changed].tolist()))
+        found.sort()
+        return found
+
+    def discretize(self, chunks: Iterable[tuple]) -> Iterator[List[tuple]]:
+        # Yields, per chunk, the (timestamp, fact, asserted) changes in order.
+        for timestamps, channel_ids, values in chunks:
+            events = []
+            for _, timestamp, k, on in self.transitions(np.asarray(timestamps),
+                                                         np.asarray(channel_ids),
+                                                         np.asarray(values, dtype=np.float64)):
+                fact = self.thresholds[k].fact
+                count = self.active.get(fact, 0)
+                self.active[fact] = count + 1 if on else count - 1
+                if count == 0 or self.active[fact] == 0:
+                    events.append((timestamp, fact, on))
+            yield events
+
+    def feed(self, kb: 'KnowledgeBase', chunks: Iterable[tuple]) -> Iterator[List[tuple]]:
+        # Pipeline stage: applies each chunk's changes to kb, then yields them.
+        for events in self.discretize(chunks):
+            kb.apply_events(events)
+            yield events
+
+def setup_manufacturing_knowledge(kb: KnowledgeBase, kg: KnowledgeGraph):
+    # Built-in manufacturing rulebase used when no rule pack is given.
+    # Quality Control Issues
+    kb.add_rule(['dimensional_variation', 'tool_wear'], 'possible_tooling_problem', 0.7)
+    kb.add_rule(['dimensional_variation', 'tool_wear', 'vibration'], 'severe_tooling_issue', 0.9)
+    kb.add_rule(['surface_defects', 'irregular_finish'], 'quality_control_issue', 0.8)
+
+    # Machine Maintenance Issues
+    kb.add_rule(['unusual_noise', 'vibration'], 'mechanical_problem', 0.75)
+    kb.add_rule(['unusual_noise', 'vibration', 'overheating'], 'serious_mechanical_issue', 0.9)
+    kb.add_rule(['power_fluctuation', 'system_trips'], 'electrical_problem', 0.85)
+
+    # Process Control Issues
+    kb.add_rule(['temperature_variation', 'pressure_fluctuation'], 'process_control_issue', 0.7)
+    kb.add_rule(['temperature_variation', 'pressure_fluctuation', 'flow_rate_unstable'], 
+                'severe_process_control', 0.9)
+
+    # Material Handling Issues
+    kb.add_rule(['feed_rate_unstable', 'material_buildup'], 'material_handling_problem', 0.8)
+    kb.add_rule(['feed_rate_unstable', 'material_buildup', 'jamming'], 
+                'severe_material_handling', 0.95)
+
+    # Production Efficiency Issues
+    kb.add_rule(['cycle_time_increase', 'output_decrease'], 'efficiency_problem', 0.75)
+    kb.add_rule(['cycle_time_increase', 'output_decrease', 'high_reject_rate'], 
+                'serious_efficiency_issue', 0.9)
+
+    # Escalations (fire on conclusions derived by the rules above)
+    kb.add_rule(['mechanical_problem', 'electrical_problem'], 'line_shutdown_risk', 0.85)
+
+    # Add rules to knowledge graph
+    for rule in kb.rules.values():
+        kg.add_rule_to_graph(rule['conditions'], rule['conclusion'])
@@ -1,58 +1,21 @@
 import sys
+import os
+import time
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
                             QHBoxLayout, QPushButton, QLabel, QTextEdit, 
                             QListWidget, QMessageBox, QFrame, QScrollArea)
-from PyQt6.QtCore import Qt
+from PyQt6.QtCore import Qt, QObject, pyqtSignal
 from PyQt6.QtGui import QFont, QColor
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
-import networkx as nx
-from typing import Dict, List, Set
+from typing import Dict, Optional
+from engine import (KnowledgeBase, KnowledgeGraph, RulePackWatcher, load_rule_pack,
+                    setup_manufacturing_knowledge)
 
-class KnowledgeBase:
-    def __init__(self):
-        self.rules = {}
-        self.facts = set()
-        self.history = []
-        
-    def add_rule(self, conditions: List[str], conclusion: str, confidence: float):
-        rule_id = len(self.rules)
-        self.rules[rule_id] = {
-            'conditions': conditions,
-            'conclusion': conclusion,
-            'confidence': confidence
-        }
-        
-    def add_fact(self, fact: str):
-        self.facts.add(fact)
-        self.history.append(f"Added indicator: {fact}")
-        
-    def evaluate_rules(self) -> List[Dict]:
-        conclusions = []
-        for rule_id, rule in self.rules.items():
-            if all(cond in self.facts for cond in rule['conditions']):
-                conclusions.append({
-                    'conclusion': rule['conclusion'],
-                    'confidence': rule['confidence'],
-                    'rule_id': rule_id
-                })
-        return conclusions
-
-class KnowledgeGraph:
-    def __init__(self):
-        self.graph = nx.DiGraph()
-        
-    def add_rule_to_graph(self, conditions: List[str], conclusion: str):
-        for condition in conditions:
-            self.graph.add_edge(condition, conclusion)
-            
-    def plot(self, canvas: FigureCanvas):
-        canvas.figure.clear()
-        pos = nx.spring_layout(self.graph)
-        nx.draw(self.graph, pos, with_labels=True, node_color='lightgreen', 
-                node_size=2000, font_size=8, arrows=True,
-                edge_color='gray', ax=canvas.figure.add_subplot(111))
-        canvas.draw()
+class RuleReloadBridge(QObject):
+    # Carries reloads from the watcher thread to the GUI thread.
+    reloaded = pyqtSignal(object, object, dict)
+    failed = pyqtSignal(str)
 
 class StyledButton(QPushButton):
     def __init__(self, text, primary=False):
@@ -91,42 +54,64 @@ class StyledButton(QPushButton):
             """)
 
 class ManufacturingExpertSystem(QMainWindow):
-    def __init__(self):
+    def __init__(self, rule_pack: Optional[str] = None):
         super().__init__()
         self.kb = KnowledgeBase()
         self.kg = KnowledgeGraph()
-        self.setup_manufacturing_knowledge()
+        self.watcher = None
+        load_error = None
+        if rule_pack is not None and os.path.exists(rule_pack):
+            try:
+                self.kb, self.kg = load_rule_pack(rule_pack)
+            except Exception as e:
+                # Start on the built-in rules; the watcher picks up a fix.
+                load_error = f"{rule_pack}: {e}"
+                self.kb, self.kg = KnowledgeBase(), KnowledgeGraph()
+                self.setup_manufacturing_knowledge()
+        else:
+            self.setup_manufacturing_knowledge()
         self.init_ui()
-        
-    def setup_manufacturing_knowledge(self):
-        # Quality Control Issues
-        self.kb.add_rule(['dimensional_variation', 'tool_wear'], 'possible_tooling_problem', 0.7)
-        self.kb.add_rule(['dimensional_variation', 'tool_wear', 'vibration'], 'severe_tooling_issue', 0.9)
-        self.kb.add_rule(['surface_defects', 'irregular_finish'], 'quality_control_issue', 0.8)
-
-        # Machine Maintenance Issues
-        self.kb.add_rule(['unusual_noise', 'vibration'], 'mechanical_problem', 0.75)
-        self.kb.add_rule(['unusual_noise', 'vibration', 'overheating'], 'serious_mechanical_issue', 0.9)
-        self.kb.add_rule(['power_fluctuation', 'system_trips'], 'electrical_problem', 0.85)
+        if load_error is not None:
+            self.kb.history.append(f"Rule pack failed to load, using built-in rules: {load_error}")
+            self.update_history()
+        if rule_pack is not None:
+            self.watch_rule_pack(rule_pack)
 
-        # Process Control Issues
-        self.kb.add_rule(['temperature_variation', 'pressure_fluctuation'], 'process_control_issue', 0.7)
-        self.kb.add_rule(['temperature_variation', 'pressure_fluctuation', 'flow_rate_unstable'], 
-                        'severe_process_control', 0.9)
+    def watch_rule_pack(self, path: str):
+        self.reload_bridge = RuleReloadBridge()
+        self.reload_bridge.reloaded.connect(self.swap_rulebase)
+        self.reload_bridge.failed.connect(self.report_reload_error)
+        self.watcher = RulePackWatcher(
+            path, self.reload_bridge.reloaded.emit,
+            lambda e: self.reload_bridge.failed.emit(f"{path}: {e}"),
+            engine=self.kb.engine).start()
 
-        # Material Handling Issues
-        self.kb.add_rule(['feed_rate_unstable', 'material_buildup'], 'material_handling_problem', 0.8)
-        self.kb.add_rule(['feed_rate_unstable', 'material_buildup', 'jamming'], 
-                        'severe_material_handling', 0.95)
+    def swap_rulebase(self, kb: KnowledgeBase, kg: KnowledgeGraph, stats: Dict):
+        # Runs on the GUI thread, so no analysis is mid-way; analyze() binds
+        # the rulebase it started with in any case.
+        kb.facts = set(self.kb.facts)
+        kb.sync_facts()
+        kb.history = self.kb.history
+        self.kb, self.kg = kb, kg
+        self.kg.plot(self.canvas)
+        latency = (time.perf_counter() - stats['detected']) * 1000
+        self.kb.history.append(
+            f"Reloaded {stats['rules']} rules from {os.path.basename(stats['path'])}: "
+            f"parse {stats['parse_ms']:.1f} ms, compile {stats['compile_ms']:.1f} ms, "
+            f"latency {latency:.1f} ms")
+        self.update_history()
 
-        # Production Efficiency Issues
-        self.kb.add_rule(['cycle_time_increase', 'output_decrease'], 'efficiency_problem', 0.75)
-        self.kb.add_rule(['cycle_time_increase', 'output_decrease', 'high_reject_rate'], 
-                        'serious_efficiency_issue', 0.9)
+    def report_reload_error(self, message: str):
+        self.kb.history.append(f"Rule reload failed: {message}")
+        self.update_history()
 
-        # Add rules to knowledge graph
-        for rule in self.kb.rules.values():
-            self.kg.add_rule_to_graph(rule['conditions'], rule['conclusion'])
+    def closeEvent(self, event):
+        if self.watcher is not None:
+            self.watcher.stop()
+        super().closeEvent(event)
+        
+    def setup_manufacturing_knowledge(self):
+        setup_manufacturing_knowledge(self.kb, self.kg)
 
     def init_ui(self):
         self.setWindowTitle('Manufacturing Process Expert System')
@@ -309,22 +294,22 @@ class ManufacturingExpertSystem(QMainWindow):
             self.update_history()
 
     def clear_indicators(self):
-        self.kb.facts.clear()
+        self.kb.clear_facts()
         self.indicators_list.clear()
         self.kb.history.append("Cleared all indicators")
         self.update_history()
 
     def analyze(self):
-        conclusions = self.kb.evaluate_rules()
+        kb, kg = self.kb, self.kg
+        conclusions = kb.analyze(kg)
         if conclusions:
-            conclusions.sort(key=lambda x: x['confidence'], reverse=True)
             analysis_text = "Analysis Results:\n"
             for c in conclusions:
                 analysis_text += f"- {c['conclusion'].replace('_', ' ').title()}\n"
                 analysis_text += f"  Confidence: {c['confidence']*100}%\n"
             
             QMessageBox.information(self, "Analysis Results", analysis_text)
-            self.kb.history.append(analysis_text)
+            kb.history.append(analysis_text)
             self.update_history()
         else:
             QMessageBox.information(self, "Analysis Results", 
@@ -338,7 +323,9 @@ class ManufacturingExpertSystem(QMainWindow):
 def main():
     app = QApplication(sys.argv)
     app.setStyle('Fusion')
-    ex = ManufacturingExpertSystem()
+    # Optional rule pack path; it is watched and reloaded while running.
+    args = app.arguments()[1:]
+    ex = ManufacturingExpertSystem(args[0] if args else None)
     ex.show()
     sys.exit(app.exec())
 